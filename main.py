@@ -13,11 +13,22 @@ def main(args):
     import logging
     logger = logging.getLogger('synconce')
 
-    from synconce import execute
+    from synconce import execute, maintain, reconcile
+    if args.maintenance:
+        action = maintain
+    elif args.reconcile:
+        action = reconcile
+    else:
+        action = execute
     for section in config.sections():
         if section.startswith('sync_'):
             try:
-                execute(config[section])
+                if args.profile:
+                    from synconce.profiling import profile
+                    with profile(args.profile, section):
+                        action(config[section])
+                else:
+                    action(config[section])
             except Exception:
                 import traceback
                 logger.error(traceback.format_exc())
@@ -31,6 +42,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-c', '--config', required=True)
+    actions = parser.add_mutually_exclusive_group()
+    actions.add_argument('-m', '--maintenance', action='store_true',
+                         help='prune and compact trackers instead of syncing')
+    actions.add_argument('-r', '--reconcile', action='store_true',
+                         help='track local files already on the remote'
+                              ' instead of syncing')
+    parser.add_argument('-p', '--profile', metavar='DIR',
+                        help='write cProfile, tracemalloc and span traces'
+                             ' of each section into DIR')
 
     args = parser.parse_args()
 
@@ -1 +1,2 @@
-from .tracker import execute
+from .tracker import execute, maintain
+from .reconcile import reconcile
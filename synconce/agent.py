@@ -0,0 +1,136 @@
+import io
+import os
+import json
+import shlex
+import hashlib
+import itertools
+
+from . import hashes
+from .remote import Remote
+
+import logging
+logger = logging.getLogger('synconce.agent')
+
+HELPER_SOURCE = os.path.join(os.path.dirname(__file__), 'helper.py')
+
+
+class AgentError(IOError):
+    pass
+
+
+class Agent(object):
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.ids = itertools.count()
+        self.responses = {}
+        self.next_response = 0
+
+    def request(self, op, **args):
+        req_id = next(self.ids)
+        self.stdin.write(json.dumps(dict(args, id=req_id, op=op)).encode()
+                         + b'\n')
+        self.stdin.flush()
+
+        def collect():
+            # responses arrive in request order; buffer those for
+            # requests issued earlier but not yet collected
+            while req_id not in self.responses:
+                line = self.stdout.readline()
+                if not line:
+                    raise AgentError('Remote helper exited')
+                resp = json.loads(line)
+                self.responses[resp['id']] = resp
+
+            resp = self.responses.pop(req_id)
+            if 'error' not in resp:
+                return resp['result']
+            if resp['errno'] is not None:
+                raise OSError(resp['errno'], resp['error'])
+            raise AgentError(resp['error'])
+
+        return collect
+
+    def call(self, op, **args):
+        return self.request(op, **args)()
+
+    def close(self):
+        self.stdin.channel.close()
+
+
+class AgentRemote(Remote):
+    def __init__(self, ssh, base, agent):
+        super().__init__(ssh, base)
+        self.agent = agent
+
+    def space_free(self, path):
+        return self.agent.request('df', path=path)
+
+    def hashsum(self, path, algo):
+        command = hashes.get(algo).command
+        return self.agent.request('hash', path=path, algo=algo,
+                                  command=command)
+
+
+class AgentSFTP(object):
+    # stat/mkdir/rename go through the helper; everything else,
+    # notably file transfers, still uses the real SFTP client
+    def __init__(self, sftp, agent):
+        self.sftp = sftp
+        self.agent = agent
+
+    def __getattr__(self, name):
+        return getattr(self.sftp, name)
+
+    def stat(self, path):
+        import paramiko
+        attr = paramiko.SFTPAttributes()
+        for key, value in self.agent.call('stat', path=path).items():
+            setattr(attr, key, value)
+        return attr
+
+    def mkdir(self, path):
+        self.agent.call('mkdir', path=path)
+
+    def posix_rename(self, oldpath, newpath):
+        self.agent.call('rename', src=oldpath, dst=newpath)
+
+
+def upload_helper(sftp):
+    with open(HELPER_SOURCE, 'rb') as f:
+        source = f.read()
+
+    # keep the helper out of the synchronized tree
+    digest = hashlib.sha1(source).hexdigest()[:12]
+    path = f'{sftp.normalize(".")}/.synconce-helper-{digest}.py'
+
+    try:
+        attr = sftp.stat(path)
+    except FileNotFoundError:
+        attr = None
+
+    if attr is None or attr.st_size != len(source):
+        logger.info(f'Uploading remote helper to {path}')
+        sftp.putfo(io.BytesIO(source), path, len(source))
+
+    return path
+
+
+def start_agent(ssh, sftp, base, python):
+    # call before chdir-ing sftp, so the helper lands in the login directory
+    import paramiko
+    agent = None
+    try:
+        path = upload_helper(sftp)
+        stdin, stdout, stderr = ssh.exec_command(
+            shlex.join([python, path, base]))
+        agent = Agent(stdin, stdout)
+        agent.call('ping')
+    except (IOError, paramiko.SSHException) as e:
+        logger.warn(f'Remote helper unavailable ({e}); not using it')
+        if agent:
+            agent.close()
+        return None
+
+    logger.info(f'Remote helper started with {python}')
+    return agent
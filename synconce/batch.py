@@ -0,0 +1,138 @@
+import io
+import os
+import shlex
+import tarfile
+
+from . import utils
+from . import hashes
+from .sync import remember_digest, tmp_path
+from .profiling import traced
+
+import logging
+logger = logging.getLogger('synconce.batch')
+
+# moves each extracted tmp file into place unless the destination exists;
+# stdin: pairs of lines (tmp, dest); stdout: "ok <dest>" per moved file
+RENAME_SCRIPT = '''
+cd "$1" || exit 1
+while IFS= read -r tmp && IFS= read -r dest; do
+    if [ -e "$dest" ]; then
+        rm -f -- "$tmp"
+    elif mv -f -- "$tmp" "$dest"; then
+        printf 'ok %s\\n' "$dest"
+    fi
+done
+'''
+
+
+def batchable(candidate):
+    # names are sent line by line to RENAME_SCRIPT
+    return '\n' not in str(candidate.path / candidate.filename)
+
+
+def tmp_name(candidate):
+    return tmp_path(candidate.path, candidate.filename)
+
+
+def read_small(context, candidate):
+    with utils.open_local(candidate.full_pathname,
+                          context.config.get('io_mode')) as f:
+        attr = os.fstat(f.fileno())
+        data = f.read(candidate.size + 1)
+
+    if len(data) != candidate.size:
+        # changed since walked; a tar member can't be resized mid-stream
+        logger.warn(f'{candidate.full_pathname} changed size'
+                    f' ({candidate.size:,} -> {len(data):,} bytes)'
+                    f'; leaving it out of the batch')
+        return None
+
+    algo = context.hash_algo
+    hasher = hashes.new(algo)
+    hasher.update(data)
+    remember_digest(context, candidate.full_pathname, candidate.size, attr,
+                    algo, hasher.hexdigest())
+    return data
+
+
+@traced
+def send_tar(context, candidates):
+    remote = context.remote
+    stdin, stdout, stderr = remote.ssh.exec_command(shlex.join(
+        ['tar', '-x', '-f', '-', '-C', remote.base]))
+
+    sent = []
+    with tarfile.open(fileobj=stdin, mode='w|') as tar:
+        for candidate in candidates:
+            try:
+                data = read_small(context, candidate)
+            except OSError as e:
+                logger.warn(f'Cannot read {candidate.full_pathname}: {e}')
+                data = None
+            if data is None:
+                continue
+
+            info = tarfile.TarInfo(str(tmp_name(candidate)))
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(candidate.full_pathname.stat().st_mtime)
+            tar.addfile(info, io.BytesIO(data))
+            sent.append(candidate)
+
+    stdin.channel.shutdown_write()
+    err = stderr.read()
+    status = stdout.channel.recv_exit_status()
+
+    if status != 0:
+        logger.error(f'Remote tar exited with {status}: {repr(err)}')
+        return []
+
+    return sent
+
+
+@traced
+def move_into_place(context, candidates):
+    remote = context.remote
+    stdin, stdout, stderr = remote.ssh.exec_command(shlex.join(
+        ['sh', '-c', RENAME_SCRIPT, 'sh', remote.base]))
+
+    for candidate in candidates:
+        stdin.write(os.fsencode(str(tmp_name(candidate))) + b'\n')
+        stdin.write(os.fsencode(str(candidate.path / candidate.filename))
+                    + b'\n')
+    stdin.flush()
+    stdin.channel.shutdown_write()
+
+    moved = {os.fsdecode(line[3:]) for line in stdout.read().splitlines()
+             if line.startswith(b'ok ')}
+    stdout.channel.close()
+
+    return [candidate for candidate in candidates
+            if str(candidate.path / candidate.filename) in moved]
+
+
+@traced
+def do_batch(context, candidates):
+    min_free = context.config.getint('min_free')
+    size = sum(candidate.size for candidate in candidates)
+    logger.info(f'Synchronizing batch of {len(candidates)} files'
+                f' ({size:,} bytes)')
+
+    space_free = context.remote.space_free('.')()
+    if space_free - size < min_free:
+        logger.error(f'Space available ({space_free:,} bytes)'
+                     f' is not enough to store batch'
+                     f': min_free {min_free:,} bytes'
+                     f', size {size:,} bytes'
+                     f', space after transfer {space_free - size:,} bytes')
+        return []
+
+    sent = send_tar(context, candidates)
+    context.budget.take(sum(candidate.size for candidate in sent))
+    if not sent:
+        return []
+
+    synced = move_into_place(context, sent)
+    logger.info(f'Batch complete: {len(synced)} of {len(candidates)}'
+                f' files in place')
+    return synced
@@ -0,0 +1,60 @@
+import time
+
+import logging
+logger = logging.getLogger('synconce.budget')
+
+
+class Budget(object):
+    # how long a run may take and how much it may send; None is unlimited
+    def __init__(self, seconds=None, size=None):
+        self.start = time.monotonic()
+        self.deadline = self.start + seconds if seconds else None
+        self.size = size
+        self.spent = 0
+        self.deferred_files = 0
+        self.deferred_size = 0
+        self.stopped = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.getfloat('time_budget', 0) or None,
+                   config.getint('byte_budget', 0) or None)
+
+    def exhausted(self):
+        return ((self.deadline is not None
+                 and time.monotonic() >= self.deadline)
+                or (self.size is not None and self.spent >= self.size))
+
+    def fits(self, size):
+        if self.size is not None and self.spent + size > self.size:
+            return False
+
+        if self.deadline is not None and self.spent:
+            # at the rate of this run so far
+            now = time.monotonic()
+            rate = self.spent / max(now - self.start, 1e-3)
+            if now + size / rate > self.deadline:
+                return False
+
+        return True
+
+    def take(self, size):
+        self.spent += size
+
+    def defer(self, size):
+        self.deferred_files += 1
+        self.deferred_size += size
+
+    def report(self):
+        if self.deadline is None and self.size is None:
+            return
+
+        logger.info(f'Scheduled {self.spent:,} bytes in'
+                    f' {time.monotonic() - self.start:.0f}s')
+        if self.deferred_files:
+            logger.info(f'Left for later: {self.deferred_files} files'
+                        f' ({self.deferred_size:,} bytes) not fitting the'
+                        f' budget')
+        if self.stopped:
+            logger.info('Budget used up; the rest of the tree was not'
+                        ' walked')
@@ -1,10 +1,14 @@
+import time
 import contextlib
 
 import sqlite3
-import paramiko
 
+from . import hashes
+from . import tuning
+from .budget import Budget
 from .remote import Remote
-from .sync import do_sync
+from .sync import do_sync, do_move
+from .batch import do_batch
 
 import logging
 logger = logging.getLogger('synconce.context')
@@ -16,26 +20,159 @@ class Context(object):
     cursor = None
     ssh = None
     sftp = None
+    remote = None
+    agent = None
+    hash_algo = hashes.DEFAULT
+    connected = False
+    # set once reconnecting after a lost transport failed
+    gave_up = False
+    # a fan-out destination dropped from the run
+    failed = False
+    exec_command = None
+    writers = None
+    chunk_size = tuning.DEFAULT_CHUNK_SIZE
     do_sync = staticmethod(do_sync)
+    do_move = staticmethod(do_move)
+    do_batch = staticmethod(do_batch)
+
+    def __init__(self):
+        self.local_digests = {}
+        self.synced_files = []
+        self.budget = Budget()
+
+    def transport_lost(self):
+        return False
+
+    def negotiated(self, name):
+        return getattr(self, name)
+
+
+class Connected(object):
+    # an attribute of LazyContext that connects on first access
+    def __set_name__(self, owner, name):
+        self.name = f'_{name}'
+
+    def __get__(self, context, owner=None):
+        if context is None:
+            return self
+        if not context.connected:
+            context.connect()
+        return getattr(context, self.name)
+
+    def __set__(self, context, value):
+        setattr(context, self.name, value)
+
+
+class LazyContext(Context):
+    ssh = Connected()
+    sftp = Connected()
+    remote = Connected()
+    agent = Connected()
+    hash_algo = Connected()
+
+    def __init__(self):
+        super().__init__()
+        self.connection = None
+
+    def negotiated(self, name):
+        # from the last connection, if any, without connecting again
+        return getattr(self, f'_{name}', None)
+
+    def connect(self):
+        # paramiko is slow to import; runs with nothing to sync skip it
+        import paramiko
+        from .agent import start_agent, AgentRemote, AgentSFTP
+
+        config = self.config
+        logger.info(f'Connecting to {config["user"]}@{config["host"]}'
+                    f':{config["port"]}')
+
+        with contextlib.ExitStack() as connection:
+            key = paramiko.RSAKey.from_private_key_file(config['rsa_key'])
+            ssh = connection.enter_context(paramiko.SSHClient())
+            ssh.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+            ssh.connect(config['host'], config.getint('port'),
+                        username=config['user'], pkey=key,
+                        transport_factory=tuning.transport_factory(config))
+            transport = ssh.get_transport()
+            transport.set_keepalive(config.getint('keepalive', 0))
+
+            # applies to the channels opened from now on; inbound only
+            tuned = tuning.tune(config, transport)
+            transport.default_window_size = tuned.window_size
+            transport.default_max_packet_size = tuned.packet_size
+            self.chunk_size = tuned.chunk_size
+
+            sftp = connection.enter_context(ssh.open_sftp())
+            agent = None
+            if config.getboolean('helper', False):
+                agent = start_agent(ssh, sftp, config['remote'],
+                                    config.get('helper_python', 'python3'))
+                if agent:
+                    connection.callback(agent.close)
+
+            sftp.chdir(config['remote'])
+            if agent:
+                self._sftp = AgentSFTP(sftp, agent)
+                self._remote = AgentRemote(ssh, sftp.getcwd(), agent)
+            else:
+                self._sftp = sftp
+                self._remote = Remote(ssh, sftp.getcwd())
+            self._ssh = ssh
+            self._agent = agent
+            self._hash_algo = hashes.negotiate(
+                self._remote, config.get('hash', 'auto'))
+
+            # keep everything open past this block
+            self.connection = connection.pop_all()
+
+        self.connected = True
+
+    def disconnect(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except Exception as e:
+                logger.debug(f'Error closing connection: {e}')
+        self.connection = None
+        self.connected = False
+
+    def transport_lost(self):
+        if not self.connected:
+            return False
+        transport = self._ssh.get_transport()
+        return transport is None or not transport.is_active()
+
+    def reconnect(self):
+        self.disconnect()
+
+        attempts = self.config.getint('reconnect_attempts', 5)
+        delay = self.config.getfloat('reconnect_delay', 1)
+        max_delay = self.config.getfloat('reconnect_max_delay', 60)
+
+        for attempt in range(1, attempts + 1):
+            logger.info(f'Reconnecting in {delay:g}s'
+                        f' (attempt {attempt}/{attempts})')
+            time.sleep(delay)
+            try:
+                self.connect()
+                return True
+            except Exception as e:
+                logger.warn(f'Reconnection failed: {e}')
+                delay = min(delay * 2, max_delay)
+
+        return False
 
 
 @contextlib.contextmanager
 def create_context(config):
-    context = Context()
+    context = LazyContext()
     context.config = config
 
     with contextlib.closing(sqlite3.connect(config['data'])) as context.db:
         context.cursor = context.db.cursor()
 
-        key = paramiko.RSAKey.from_private_key_file(config['rsa_key'])
-        with paramiko.SSHClient() as context.ssh:
-            context.ssh.set_missing_host_key_policy(
-                paramiko.client.AutoAddPolicy())
-            context.ssh.connect(config['host'], config.getint('port'),
-                                username=config['user'], pkey=key)
-
-            with context.ssh.open_sftp() as context.sftp:
-                context.sftp.chdir(config['remote'])
-                context.remote = Remote(context.ssh, context.sftp.getcwd())
-
-                yield context
+        try:
+            yield context
+        finally:
+            context.disconnect()
@@ -0,0 +1,192 @@
+import contextlib
+import configparser
+
+from .context import create_context
+from .sync import prepare_sync, tee_transfer, do_rename, tmp_path, \
+    FULL_TRANSFER
+from .tracker import locked, init_db, walk, check_file, sync_candidate, \
+    record_synced, try_move, finish, fits_budget
+from .budget import Budget
+
+import logging
+logger = logging.getLogger('synconce.fanout')
+
+
+def destination_configs(config):
+    # each destination section overrides the keys of the sync_* section,
+    # typically host/port/user/rsa_key/remote and its own tracker data
+    # values are interpolated here, in their own sections; [DEFAULT] only
+    # fills in what neither the sync_* nor the destination section sets
+    parser = configparser.ConfigParser(interpolation=None)
+    source = config.parser
+    base = dict(source.items(config.name))
+    del base['destinations']
+
+    for name in config['destinations'].split(','):
+        name = name.strip()
+        if not source.has_section(name):
+            logger.error(f'Destination {name} of {config.name} has no'
+                         f' section; skipped')
+            continue
+
+        values = dict(base)
+        values.update((key, source.get(name, key))
+                      for key in own_keys(source, name))
+        parser.read_dict({name: values})
+        yield parser[name]
+
+
+def own_keys(parser, name):
+    # ConfigParser has no public way to tell the keys a section sets from
+    # those it inherits from [DEFAULT]: options() and items() merge both,
+    # and comparing with defaults() mistakes a key set to its default
+    # value for an inherited one. _sections holds just the section's own.
+    return list(parser._sections[name])
+
+
+def isolated(context, func, *args):
+    # a destination that cannot be reached, or that gave up reconnecting,
+    # is dropped from the run; the others go on
+    try:
+        return func(context, *args)
+    except Exception as e:
+        if context.connected and not context.gave_up:
+            raise
+        logger.error(f'Dropping destination {context.config.name}: {e}')
+        context.failed = True
+        return False
+
+
+def prepare_target(context, candidate):
+    if try_move(context, candidate):
+        return True
+
+    full_pathname, pathname, size, path, filename = candidate
+    try:
+        result = prepare_sync(context, full_pathname, size, path, filename)
+    except Exception:
+        if not context.transport_lost():
+            raise
+        # let the per-file path reconnect and resume
+        return sync_candidate(context, candidate)
+
+    if result is FULL_TRANSFER:
+        return result
+    if result:
+        record_synced(context, candidate)
+        return True
+    return False
+
+
+def sync_fanout(targets):
+    # targets are (context, candidate) for the destinations needing this
+    # file; whatever needs a full transfer is sent with a single read
+    synced = False
+    pending = []
+
+    for context, candidate in targets:
+        result = isolated(context, prepare_target, candidate)
+        if result is FULL_TRANSFER:
+            pending.append((context, candidate))
+        elif result:
+            synced = True
+
+    if not pending:
+        return synced
+
+    candidate = pending[0][1]
+    logger.info(f'Sending {candidate.full_pathname} to {len(pending)}'
+                f' destinations')
+    done = tee_transfer(
+        [(context, tmp_path(candidate.path, candidate.filename))
+         for context, candidate in pending],
+        candidate.full_pathname, candidate.size)
+
+    for context, candidate in pending:
+        dest_tmp = tmp_path(candidate.path, candidate.filename)
+        if context in done and do_rename(
+                context, dest_tmp, candidate.path / candidate.filename):
+            record_synced(context, candidate)
+            synced = True
+        else:
+            # retry alone; a partial tmp file is resumed
+            this_synced = isolated(context, sync_candidate, candidate)
+            synced = synced or this_synced  # short-circuit calculation
+
+    return synced
+
+
+def walk_fanout(contexts):
+    # the contexts share one budget
+    budget = contexts[0].budget
+    active = [context for context in contexts if not context.failed]
+    synced = False
+
+    for root, filename in walk(contexts[0], contexts):
+        if budget.exhausted():
+            budget.stopped = True
+            break
+
+        targets = []
+        for context in active:
+            candidate = check_file(context, root, filename)
+            if candidate:
+                targets.append((context, candidate))
+
+        if targets and not fits_budget(budget, targets):
+            continue
+
+        if len({candidate.size for context, candidate in targets}) > 1:
+            # changed between checks; don't tee different sizes
+            results = [isolated(context, sync_candidate, candidate)
+                       for context, candidate in targets]
+            this_synced = any(results)
+        elif len(targets) == 1:
+            context, candidate = targets[0]
+            this_synced = isolated(context, sync_candidate, candidate)
+        elif targets:
+            this_synced = sync_fanout(targets)
+        else:
+            this_synced = False
+
+        synced = synced or this_synced  # short-circuit calculation
+        active = [context for context in active if not context.failed]
+        if not active:
+            logger.error('No destination left; ending the run early')
+            break
+
+    return synced
+
+
+def execute_fanout(config, do_sync=None, exec_command=None):
+    logger.info(f'Starting fan-out sync for {dict(config)}')
+
+    destinations = list(destination_configs(config))
+    if len({destination['data'] for destination in destinations}) \
+            < len(destinations):
+        logger.error('Each destination needs its own tracker data')
+        return
+
+    with locked(config) as lock_acquired:
+        if not lock_acquired:
+            return
+
+        budget = Budget.from_config(config)
+        with contextlib.ExitStack() as stack:
+            contexts = []
+            for destination in destinations:
+                context = stack.enter_context(create_context(destination))
+                if do_sync:
+                    context.do_sync = do_sync
+                if exec_command:
+                    context.exec_command = exec_command
+                context.budget = budget
+                init_db(context.db, context.cursor)
+                contexts.append(context)
+
+            # a destination giving up is dropped; the others go on
+            walk_fanout(contexts)
+
+            for context in contexts:
+                finish(context)
+            budget.report()
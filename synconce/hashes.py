@@ -0,0 +1,92 @@
+import os
+import importlib
+
+import logging
+logger = logging.getLogger('synconce.hashes')
+
+
+class HashAlgorithm(object):
+    def __init__(self, name, command, module, constructor):
+        self.name = name
+        self.command = command
+        self.module = module
+        self.constructor = constructor
+
+    def new(self):
+        module = importlib.import_module(self.module)
+        return getattr(module, self.constructor)()
+
+    @property
+    def digest_size(self):
+        return self.new().digest_size
+
+    def available(self):
+        try:
+            self.new()
+        except (ImportError, AttributeError, ValueError):
+            return False
+        return True
+
+
+# ordered by preference: fastest first
+ALGORITHMS = {algo.name: algo for algo in [
+    HashAlgorithm('blake3', 'b3sum', 'blake3', 'blake3'),
+    HashAlgorithm('xxh128', 'xxh128sum', 'xxhash', 'xxh3_128'),
+    HashAlgorithm('blake2b', 'b2sum', 'hashlib', 'blake2b'),
+    HashAlgorithm('sha1', 'sha1sum', 'hashlib', 'sha1'),
+]}
+
+DEFAULT = 'sha1'
+
+
+def get(name):
+    return ALGORITHMS[name]
+
+
+def new(name):
+    return get(name).new()
+
+
+def candidates(preference):
+    if not preference or preference == 'auto':
+        names = list(ALGORITHMS)
+    else:
+        names = [name.strip() for name in preference.split(',')]
+
+    result = []
+    for name in names:
+        if name not in ALGORITHMS:
+            logger.warn(f'Unknown hash algorithm {name}; ignored')
+        elif not ALGORITHMS[name].available():
+            logger.info(f'Hash algorithm {name} unavailable locally')
+        else:
+            result.append(ALGORITHMS[name])
+    return result
+
+
+def negotiate(remote, preference):
+    local = candidates(preference)
+    if not local:
+        logger.warn(f'No usable hash algorithm in {repr(preference)}'
+                    f', falling back to {DEFAULT}')
+        return DEFAULT
+
+    remote_commands = remote.probe_commands(
+        [algo.command for algo in local])
+
+    for algo in local:
+        if algo.command in remote_commands:
+            logger.info(f'Negotiated hash algorithm {algo.name}'
+                        f' ({algo.command})')
+            return algo.name
+
+    logger.warn(f'Remote supports none of'
+                f' {", ".join(algo.command for algo in local)}'
+                f', falling back to {DEFAULT}')
+    return DEFAULT
+
+
+def parse_probe(output):
+    return {os.path.basename(line.strip())
+            for line in output.decode(errors='replace').splitlines()
+            if line.strip()}
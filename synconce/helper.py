@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Remote helper for synconce. Uploaded to and run on the remote host,
+# so it must not depend on anything but the standard library.
+#
+# Protocol: one JSON object per line on stdin, one response per line on
+# stdout, in request order. Paths are relative to the base directory
+# given as argv[1].
+
+import os
+import sys
+import json
+import hashlib
+import subprocess
+
+
+def op_stat(req):
+    attr = os.stat(req['path'])
+    return {'st_mode': attr.st_mode, 'st_size': attr.st_size,
+            'st_uid': attr.st_uid, 'st_gid': attr.st_gid,
+            'st_atime': int(attr.st_atime), 'st_mtime': int(attr.st_mtime)}
+
+
+def op_mkdir(req):
+    os.mkdir(req['path'])
+
+
+def op_df(req):
+    vfs = os.statvfs(req['path'])
+    return vfs.f_bavail * vfs.f_frsize
+
+
+def op_hash(req):
+    if req['algo'] in hashlib.algorithms_available:
+        hasher = hashlib.new(req['algo'])
+        with open(req['path'], 'rb') as f:
+            for data in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    output = subprocess.run([req['command'], req['path']], check=True,
+                            stdout=subprocess.PIPE).stdout
+    return output.split()[0].decode('ascii')
+
+
+def op_rename(req):
+    os.rename(req['src'], req['dst'])
+
+
+def op_ping(req):
+    return 'pong'
+
+
+OPS = {
+    'stat': op_stat,
+    'mkdir': op_mkdir,
+    'df': op_df,
+    'hash': op_hash,
+    'rename': op_rename,
+    'ping': op_ping,
+}
+
+
+def main():
+    os.chdir(sys.argv[1])
+
+    for line in sys.stdin:
+        req = json.loads(line)
+        try:
+            resp = {'id': req['id'], 'result': OPS[req['op']](req)}
+        except OSError as e:
+            resp = {'id': req['id'], 'errno': e.errno, 'error': str(e)}
+        except Exception as e:
+            resp = {'id': req['id'], 'errno': None, 'error': repr(e)}
+
+        sys.stdout.write(json.dumps(resp) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
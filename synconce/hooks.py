@@ -0,0 +1,42 @@
+import io
+import os
+import json
+import shlex
+import collections
+
+from .profiling import traced
+
+import logging
+logger = logging.getLogger('synconce.hooks')
+
+
+SyncedFile = collections.namedtuple(
+    'SyncedFile', ['path', 'size', 'algo', 'digest'])
+
+
+def manifest(entries):
+    return b''.join(json.dumps(entry._asdict()).encode() + b'\n'
+                    for entry in entries)
+
+
+@traced
+def run_post_sync(context, entries):
+    config = context.config
+    command = config['post_sync']
+    mode = config.get('post_sync_input', 'none')
+    exec_command = context.exec_command or context.remote.exec_command
+
+    logger.info(f'Running post_sync for {len(entries)} files: {command}')
+
+    if mode == 'stdin':
+        out, err = exec_command(command, manifest(entries))
+    elif mode == 'manifest':
+        path = config.get('post_sync_manifest', '.synconce-manifest.jsonl')
+        data = manifest(entries)
+        context.sftp.putfo(io.BytesIO(data), path, len(data))
+        remote_path = os.path.join(context.remote.base, path)
+        out, err = exec_command(f'{command} {shlex.quote(remote_path)}')
+    else:
+        out, err = exec_command(command)
+
+    logger.debug(f'post_sync out={repr(out)}, err={repr(err)}')
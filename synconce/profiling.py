@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import contextlib
+import tracemalloc
+import collections
+
+import logging
+logger = logging.getLogger('synconce.profiling')
+
+# span trace output; None (the default) makes span() a no-op
+_trace = None
+_trace_lock = threading.Lock()
+_local = threading.local()
+
+
+def start_trace(fileobj):
+    global _trace
+    _trace = fileobj
+
+
+def stop_trace():
+    global _trace
+    _trace = None
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    if _trace is None:
+        yield
+        return
+
+    stack = _local.__dict__.setdefault('stack', [])
+    # [name, children duration]
+    frame = [name, 0]
+    stack.append(frame)
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter_ns() - start
+        stack.pop()
+        if stack:
+            stack[-1][1] += duration
+
+        record = {
+            'name': name,
+            'stack': ';'.join(f[0] for f in stack + [frame]),
+            'ts': start // 1000,
+            'dur': duration // 1000,
+            'self': (duration - frame[1]) // 1000,
+            'tid': threading.get_ident(),
+            'args': {key: str(value) for key, value in args.items()},
+        }
+        with _trace_lock:
+            if _trace is not None:
+                _trace.write(json.dumps(record) + '\n')
+
+
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _trace is None:
+            return func(*args, **kwargs)
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def profile(directory, name):
+    import pstats
+    import cProfile
+
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, name)
+    logger.info(f'Profiling {name} into {base}.*')
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    with open(f'{base}.spans.jsonl', 'w') as trace:
+        start_trace(trace)
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stop_trace()
+
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(f'{base}.tracemalloc')
+            profiler.dump_stats(f'{base}.prof')
+
+            with open(f'{base}.txt', 'w') as f:
+                pstats.Stats(profiler, stream=f) \
+                    .sort_stats('cumulative').print_stats(50)
+                f.write('\nTop allocations:\n')
+                for stat in snapshot.statistics('lineno')[:20]:
+                    f.write(f'{stat}\n')
+
+
+def read_spans(fileobj):
+    return [json.loads(line) for line in fileobj if line.strip()]
+
+
+def to_chrome(spans):
+    return {'traceEvents': [{
+        'name': span['name'],
+        'ph': 'X',
+        'ts': span['ts'],
+        'dur': span['dur'],
+        'pid': 0,
+        'tid': span['tid'],
+        'args': span['args'],
+    } for span in spans]}
+
+
+def to_folded(spans):
+    # flamegraph.pl / speedscope "folded" stacks, weighted by self time (us)
+    folded = collections.Counter()
+    for span in spans:
+        folded[span['stack']] += span['self']
+    return ''.join(f'{stack} {weight}\n'
+                   for stack, weight in sorted(folded.items()))
+
+
+def main(args):
+    if len(args) != 2 or args[0] not in ('chrome', 'folded'):
+        raise SystemExit('usage: python -m synconce.profiling'
+                         ' chrome|folded SPANS.jsonl')
+
+    with open(args[1]) as f:
+        spans = read_spans(f)
+
+    if args[0] == 'chrome':
+        json.dump(to_chrome(spans), sys.stdout)
+    else:
+        sys.stdout.write(to_folded(spans))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
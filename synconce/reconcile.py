@@ -0,0 +1,115 @@
+import stat
+from pathlib import Path
+
+from .sync import remote_location, local_hash
+from .tracker import locked, init_db, walk, get_size, set_sizes, \
+    take_digest, record_hash_algo, Candidate
+from .context import create_context
+
+import logging
+logger = logging.getLogger('synconce.reconcile')
+
+
+def list_sftp(sftp, path=Path()):
+    # slow fallback for remotes without GNU find
+    files = {}
+    for attr in sftp.listdir_attr(str(path)):
+        if stat.S_ISDIR(attr.st_mode):
+            files.update(list_sftp(sftp, path / attr.filename))
+        elif stat.S_ISREG(attr.st_mode):
+            files[str(path / attr.filename)] = attr.st_size
+    return files
+
+
+def list_remote(context):
+    files = context.remote.list_files()
+    if files is None:
+        logger.warn('Remote find unusable; listing over SFTP')
+        files = list_sftp(context.sftp)
+    logger.info(f'{len(files):,} files on remote')
+    return files
+
+
+def verify(context, candidates):
+    remote = context.remote.hashsums(
+        [str(candidate.path / candidate.filename) for candidate in candidates],
+        context.hash_algo)
+
+    rows = []
+    for candidate in candidates:
+        remote_hashsum = remote.get(str(candidate.path / candidate.filename))
+        local_hashsum = local_hash(context, candidate.full_pathname,
+                                   candidate.size)
+        digest = take_digest(context, candidate)
+        if remote_hashsum == local_hashsum:
+            rows.append((candidate.pathname, candidate.size, digest))
+        else:
+            logger.warn(f'Remote ({remote_hashsum}) and local'
+                        f' ({local_hashsum}) {candidate.pathname}'
+                        f' do not match; leaving it untracked')
+    return rows
+
+
+def reconcile_walk(context):
+    # tracks local files already on the remote with the same size, and
+    # with trust = hash, also the same content
+    config = context.config
+    trust = config.get('reconcile_trust', 'size')
+    batch = config.getint('reconcile_batch', 10000)
+    local_base = Path(config['local'])
+
+    remote = list_remote(context)
+    pending = []
+    tracked = 0
+
+    def flush():
+        nonlocal tracked
+        rows = verify(context, pending) if trust == 'hash' else pending
+        set_sizes(context, rows)
+        tracked += len(rows)
+        pending.clear()
+
+    for root, filename in walk(context):
+        full_pathname = root / filename
+        pathname = full_pathname.relative_to(local_base)
+        size = full_pathname.stat().st_size
+        if get_size(context, pathname) == size:
+            continue
+
+        path, remote_filename = remote_location(config, pathname)
+        if remote.get(str(path / remote_filename)) != size:
+            continue
+
+        if trust == 'hash':
+            pending.append(Candidate(full_pathname, pathname, size, path,
+                                     remote_filename))
+        else:
+            pending.append((pathname, size, None))
+        if len(pending) >= batch:
+            flush()
+
+    if pending:
+        flush()
+
+    logger.info(f'Tracked {tracked:,} files found on remote'
+                f' (trusting {trust})')
+    return tracked
+
+
+def reconcile(config):
+    if config.get('destinations'):
+        from .fanout import destination_configs
+        for destination in destination_configs(config):
+            reconcile(destination)
+        return
+
+    logger.info(f'Starting reconciliation for {dict(config)}')
+
+    with locked(config) as lock_acquired:
+        if not lock_acquired:
+            return
+
+        with create_context(config) as context:
+            init_db(context.db, context.cursor)
+            reconcile_walk(context)
+            record_hash_algo(context)
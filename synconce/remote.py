@@ -1,7 +1,8 @@
 import os
-import hashlib
 import shlex
 
+from . import hashes
+
 
 class Remote(object):
     def __init__(self, ssh, base):
@@ -21,10 +22,11 @@ class Remote(object):
         return collect
 
     def hashsum(self, path, algo):
+        algo = hashes.get(algo)
         stdin, stdout, stderr = self.ssh.exec_command(shlex.join(
-            [f'{algo}sum', os.path.join(self.base, path)]
+            [algo.command, os.path.join(self.base, path)]
         ))
-        size = hashlib.new(algo).digest_size
+        size = algo.digest_size
 
         def collect():
             output = stdout.read(size * 2)
@@ -33,9 +35,67 @@ class Remote(object):
 
         return collect
 
-    def exec_command(self, command):
+    def copy(self, src, dest, link=False):
+        src = os.path.join(self.base, src)
+        dest = os.path.join(self.base, dest)
+        if link:
+            command = shlex.join(['ln', '-f', '--', src, dest])
+        else:
+            # --reflink is GNU only; plain cp elsewhere
+            command = (shlex.join(['cp', '--reflink=auto', '--', src, dest])
+                       + ' 2>/dev/null || '
+                       + shlex.join(['cp', '--', src, dest]))
+        stdin, stdout, stderr = self.ssh.exec_command(command)
+        status = stdout.channel.recv_exit_status()
+        stdout.channel.close()
+        return status == 0
+
+    def list_files(self):
+        # {relative path: size} of all regular files; None without GNU find
+        stdout, stderr = self.exec_command(shlex.join(
+            ['find', self.base, '-type', 'f', '-printf', '%s %P\\0']))
+        if stderr and not stdout:
+            return None
+
+        files = {}
+        for entry in stdout.split(b'\0')[:-1]:
+            size, _, path = entry.partition(b' ')
+            files[os.fsdecode(path)] = int(size)
+        return files
+
+    def hashsums(self, paths, algo):
+        # {path: digest} in one command; names the tool has to escape
+        # (backslash or newline) are left out
+        algo = hashes.get(algo)
+        stdout, stderr = self.exec_command(
+            f'cd {shlex.quote(self.base)}'
+            f' && xargs -0 {shlex.quote(algo.command)}',
+            input=b''.join(os.fsencode(f'./{path}') + b'\0'
+                           for path in paths))
+
+        digests = {}
+        for line in stdout.splitlines():
+            if line.startswith(b'\\'):
+                continue
+            digest, _, path = line.partition(b' ')
+            digests[os.fsdecode(path[1:])[2:]] = digest.decode('ascii')
+        return digests
+
+    def probe_commands(self, commands):
+        # dash's command -v only looks at its first argument
+        out, err = self.exec_command(
+            'for c in ' + ' '.join(shlex.quote(c) for c in commands)
+            + '; do command -v "$c"; done')
+        return hashes.parse_probe(out)
+
+    def exec_command(self, command, input=None):
         stdin, stdout, stderr = self.ssh.exec_command(command)
 
+        if input is not None:
+            stdin.write(input)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+
         stdout_read = stdout.read()
         stderr_read = stderr.read()
         stdout.channel.close()
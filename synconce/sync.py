@@ -1,11 +1,29 @@
+import os
 import stat
+import fnmatch
+from pathlib import Path
 
 from . import utils
+from . import hashes
+from .profiling import span, traced
 
 import logging
 logger = logging.getLogger('synconce.sync')
 
 
+def remote_location(config, pathname):
+    # (remote directory, remote filename) for a local relative pathname
+    path = pathname.parent
+    filename = pathname.name
+
+    if config.get('flatten') is not None:
+        filename = str(pathname).replace(os.path.sep, config['flatten'])
+        path = Path()
+
+    return path, filename
+
+
+@traced
 def confirm_dir(context, path):
     try:
         attr = context.sftp.stat(str(path))
@@ -31,6 +49,74 @@ def confirm_dir(context, path):
     return True
 
 
+def open_local(context, pathname):
+    return utils.open_local(pathname, context.config.get('io_mode'))
+
+
+def cached_digest(context, fileloc, size):
+    # the digest computed by the prefetch stage, if still valid
+    cached = context.local_digests.get(fileloc)
+    if cached and cached.algo == context.hash_algo and cached.size == size:
+        attr = os.stat(fileloc)
+        if (attr.st_size, attr.st_mtime_ns) == (cached.size, cached.mtime_ns):
+            return cached.digest
+    return None
+
+
+@traced
+def local_hash(context, fileloc, size):
+    algo = context.hash_algo
+
+    digest = cached_digest(context, fileloc, size)
+    if digest:
+        return digest
+
+    with open_local(context, fileloc) as f:
+        attr = os.fstat(f.fileno())
+        digest = utils.head_hash(f, size, algo)
+    remember_digest(context, fileloc, size, attr, algo, digest)
+    return digest
+
+
+def remember_digest(context, fileloc, size, attr, algo, digest):
+    # picked up by the tracker and post_sync once the file is synchronized
+    if digest is not None:
+        context.local_digests[fileloc] = utils.LocalDigest(
+            size, attr.st_mtime_ns, algo, digest)
+
+
+def open_remote(context, path, mode):
+    destf = context.sftp.open(path, mode)
+    destf.set_pipelined(True)
+    # paramiko splits writes into requests of at most this size
+    destf.MAX_REQUEST_SIZE = context.chunk_size
+    return destf
+
+
+def is_sparse(context, attr):
+    return (context.config.getboolean('sparse', False)
+            and attr.st_blocks * 512 < attr.st_size)
+
+
+def sparse_put(context, srcf, dest, start, size, hasher):
+    # like putfo, or appending from start, but holes are not sent
+    with open_remote(context, dest, 'r+b' if start else 'wb') as destf:
+        transferred = utils.sparse_transfer(srcf, destf, start, size, hasher,
+                                            context.chunk_size,
+                                            context.budget.deadline)
+        if transferred is None:
+            # leave it short; the caller's size check catches it
+            logger.warn(f'Stopped short of {size:,} bytes writing {dest}')
+            return 0
+        destf.flush()
+        destf.truncate(size)
+
+    logger.info(f'{transferred:,} of {size - start:,} bytes sent as data'
+                f'; the rest are holes')
+    return transferred
+
+
+@traced
 def maybe_partial(context, src, src_size, dest, dest_size):
     logger.info(f'Attempting partial transferring {dest}'
                 f' ({dest_size:,} bytes) from {src} ({src_size:,} bytes)')
@@ -40,55 +126,174 @@ def maybe_partial(context, src, src_size, dest, dest_size):
                      f' than local file {src} ({src_size:,} bytes)')
         return False
 
-    remote_sha1sum = context.remote.hashsum(str(dest), 'sha1')
+    algo = context.hash_algo
+    remote_hashsum = context.remote.hashsum(str(dest), algo)
 
-    with open(src, 'rb') as srcf:
-        src_sha1 = utils.head_sha1(srcf, dest_size)
-        logger.debug(f'Local head ({dest_size:,} bytes) SHA-1: {src_sha1}')
+    with open_local(context, src) as srcf:
+        src_attr = os.fstat(srcf.fileno())
+        hasher = utils.head_hasher(srcf, dest_size, algo)
 
-        if src_sha1 is None:
+        if hasher is None:
             logger.error(f'Local file {src} could not be read to {dest_size}')
             return False
 
-        dest_sha1 = remote_sha1sum()
-        logger.debug(f'Remote SHA-1: {dest_sha1}')
+        src_hash = hasher.hexdigest()
+        logger.debug(f'Local head ({dest_size:,} bytes) {algo}: {src_hash}')
+
+        with span('remote_hash'):
+            dest_hash = remote_hashsum()
+        logger.debug(f'Remote {algo}: {dest_hash}')
 
-        if src_sha1 != dest_sha1:
+        if src_hash != dest_hash:
             # head of src != dest
             logger.error(f'Head of local {src} does not match remote {dest}')
             return False
 
         logger.info('Remote file matches head of local file. Transferring...')
-        with context.sftp.open(str(dest), 'ab') as destf:
-            destf.set_pipelined(True)
-            transferred = utils.append_transfer(srcf, destf)
+        if is_sparse(context, src_attr):
+            transferred = sparse_put(context, srcf, str(dest), dest_size,
+                                     src_size, hasher)
+        else:
+            with open_remote(context, str(dest), 'ab') as destf:
+                transferred = utils.append_transfer(
+                    srcf, destf, hasher, context.chunk_size,
+                    context.budget.deadline)
         logger.info(f'{transferred:,} bytes transferred.')
 
     # at this point, the remote file should be completely written
     attr = context.sftp.stat(str(dest))
     logger.info(f'Remote file {dest} after sync: {repr(attr)}')
+    context.budget.take(max(attr.st_size - dest_size, 0))
     if attr.st_size == src_size:
+        remember_digest(context, src, src_size, src_attr, algo,
+                        hasher.hexdigest())
         return True
+    elif utils.past(context.budget.deadline):
+        logger.info(f'Stopped at the deadline; keeping {dest}'
+                    f' ({attr.st_size:,} bytes) to resume from')
+        return STOPPED
     else:
         logger.warn(f'Incomplete transferred {dest} ({attr.st_size:,} bytes)'
                     f' from {src} ({src_size:,} bytes)')
         return False
 
 
+@traced
 def full_transfer(context, src, src_size, dest):
-    with open(src, 'rb') as f:
+    if utils.past(context.budget.deadline):
+        logger.info(f'Past the deadline; not starting {dest}')
+        return False
+
+    algo = context.hash_algo
+    if cached_digest(context, src, src_size):
+        hasher = None
+    else:
+        hasher = hashes.new(algo)
+
+    with open_local(context, src) as f:
+        src_attr = os.fstat(f.fileno())
         try:
-            attr = context.sftp.putfo(f, str(dest), src_size)
+            if is_sparse(context, src_attr):
+                sparse_put(context, f, str(dest), 0, src_size, hasher)
+            else:
+                # putfo, but with our chunk size
+                with open_remote(context, str(dest), 'wb') as destf:
+                    utils.append_transfer(f, destf, hasher,
+                                          context.chunk_size,
+                                          context.budget.deadline)
+            attr = context.sftp.stat(str(dest))
+            context.budget.take(attr.st_size)
+            if attr.st_size != src_size:
+                raise IOError(f'{dest} has {attr.st_size:,} bytes')
         except IOError:
             # incomplete upload? but don't retry or resume here
             logger.warn(f'Failed/incomplete file {dest} from {src}')
             return False
 
-        # further check? or already checked by sftp.putfo()
         logger.info(f'File transferred, attr={repr(attr)}')
+        if hasher:
+            remember_digest(context, src, src_size, src_attr, algo,
+                            hasher.hexdigest())
         return True
 
 
+@traced
+def tee_transfer(targets, src, src_size):
+    # one local read feeding several remotes; targets are (context, dest)
+    # pairs. returns the contexts that received the complete file.
+    if utils.past(targets[0][0].budget.deadline):
+        logger.info(f'Past the deadline; not starting {src}')
+        return []
+
+    hashers = {context.hash_algo: hashes.new(context.hash_algo)
+               for context, dest in targets}
+    destfs = []
+
+    for context, dest in targets:
+        try:
+            destf = open_remote(context, str(dest), 'wb')
+        except IOError as e:
+            logger.warn(f'Cannot open remote {dest}: {e}')
+            continue
+        destfs.append((context, dest, destf))
+
+    def drop(target):
+        destfs.remove(target)
+        try:
+            target[2].close()
+        except Exception:
+            pass
+
+    with open_local(targets[0][0], src) as f:
+        src_attr = os.fstat(f.fileno())
+
+        try:
+            chunk = min(context.chunk_size for context, dest in targets)
+            while destfs and len(data := f.read(chunk)) > 0:
+                for hasher in hashers.values():
+                    hasher.update(data)
+
+                for target in list(destfs):
+                    try:
+                        target[2].write(data)
+                    except Exception as e:
+                        # a broken destination must not stop the others;
+                        # do_sync resumes it later from the tmp file
+                        logger.warn(f'Failed writing {target[1]}: {e}')
+                        drop(target)
+        except OSError as e:
+            logger.error(f'Failed reading {src}: {e}')
+            for target in list(destfs):
+                drop(target)
+
+    done = []
+    for context, dest, destf in destfs:
+        try:
+            # waits for the pipelined writes to be acknowledged
+            destf.close()
+            attr = context.sftp.stat(str(dest))
+        except Exception as e:
+            logger.warn(f'Failed/incomplete file {dest} from {src}: {e}')
+            continue
+
+        context.budget.take(attr.st_size)
+
+        if attr.st_size != src_size:
+            logger.warn(f'Incomplete transferred {dest}'
+                        f' ({attr.st_size:,} bytes)'
+                        f' from {src} ({src_size:,} bytes)')
+            continue
+
+        logger.info(f'File transferred to {dest}, attr={repr(attr)}')
+        algo = context.hash_algo
+        remember_digest(context, src, src_size, src_attr, algo,
+                        hashers[algo].hexdigest())
+        done.append(context)
+
+    return done
+
+
+@traced
 def do_rename(context, src, dst):
     try:
         context.sftp.posix_rename(str(src), str(dst))
@@ -99,11 +304,55 @@ def do_rename(context, src, dst):
     return True
 
 
-def do_sync(context, fileloc, size, path, filename):
+# returned by prepare_sync when only a full transfer to tmp is left
+FULL_TRANSFER = object()
+# returned by maybe_partial when the deadline cut it short
+STOPPED = object()
+
+
+def tmp_path(path, filename):
+    return path / f'.{filename}.synconce'
+
+
+def appendable(context, fileloc):
+    pattern = context.config.get('append')
+    return bool(pattern) and fnmatch.fnmatch(fileloc.name, pattern)
+
+
+@traced
+def append_sync(context, fileloc, size, path, filename, dest_size):
+    # a growing file: send the tail if the remote file is still a prefix,
+    # in place or, with append_atomic, on a server-side copy renamed over it
     min_free = context.config.getint('min_free')
-    filename_tmp = f'.{filename}.synconce'
+    atomic = context.config.getboolean('append_atomic', False)
     dest = path / filename
-    dest_tmp = path / filename_tmp
+    needed = size - dest_size + (dest_size if atomic else 0)
+
+    with span('space_free'):
+        space_free = context.remote.space_free(str(path))()
+    if space_free - needed < min_free:
+        logger.error(f'Space available ({space_free:,} bytes)'
+                     f' is not enough to append to {dest}'
+                     f': min_free {min_free:,} bytes'
+                     f', needed {needed:,} bytes')
+        return False
+
+    if not atomic:
+        return maybe_partial(context, fileloc, size, dest, dest_size) is True
+
+    dest_tmp = tmp_path(path, filename)
+    if not context.remote.copy(str(dest), str(dest_tmp)):
+        logger.warn(f'Failed copying remote {dest} to {dest_tmp}')
+        return False
+    return (maybe_partial(context, fileloc, size, dest_tmp, dest_size) is True
+            and do_rename(context, dest_tmp, dest))
+
+
+@traced
+def prepare_sync(context, fileloc, size, path, filename):
+    min_free = context.config.getint('min_free')
+    dest = path / filename
+    dest_tmp = tmp_path(path, filename)
     logger.info(f'Synchronizing {fileloc} ({size:,} bytes)'
                 f' to {dest} (tmp = {dest_tmp})')
 
@@ -121,19 +370,27 @@ def do_sync(context, fileloc, size, path, filename):
     if attr:
         logger.info(f'Remote path {dest} exists: {repr(attr)}')
 
+        if (stat.S_ISREG(attr.st_mode) and attr.st_size < size
+                and appendable(context, fileloc)):
+            return append_sync(context, fileloc, size, path, filename,
+                               attr.st_size)
+
         if not stat.S_ISREG(attr.st_mode) or attr.st_size != size:
             logger.warn('Remote path is not a file or has different size')
             return False
 
-        remote_sha1sum = context.remote.hashsum(str(dest), 'sha1')()
-        with open(fileloc, 'rb') as f:
-            local_sha1sum = utils.head_sha1(f, size)
+        algo = context.hash_algo
+        get_remote_hashsum = context.remote.hashsum(str(dest), algo)
+        local_hashsum = local_hash(context, fileloc, size)
+        with span('remote_hash'):
+            remote_hashsum = get_remote_hashsum()
 
-        if remote_sha1sum == local_sha1sum:
-            logger.info(f'Remote and local files match ({remote_sha1sum})')
+        if remote_hashsum == local_hashsum:
+            logger.info(f'Remote and local files match'
+                        f' ({algo}: {remote_hashsum})')
             return True
 
-        logger.warn(f'Remote ({remote_sha1sum}) and local ({local_sha1sum})'
+        logger.warn(f'Remote ({remote_hashsum}) and local ({local_hashsum})'
                     f' files do not match; skipping')
         return False
 
@@ -144,7 +401,8 @@ def do_sync(context, fileloc, size, path, filename):
 
     if attr_tmp:
         # tmp file already there; might be a previous incomplete transfer
-        space_free = get_space_free()
+        with span('space_free'):
+            space_free = get_space_free()
         logger.info(f'Remote tmp file {dest_tmp} exists: {repr(attr_tmp)}'
                     f'; {space_free:,} bytes available at "{path}"')
 
@@ -161,12 +419,22 @@ def do_sync(context, fileloc, size, path, filename):
             return False
 
         # if maybe_partial fails, fall back to full_transfer
-        if maybe_partial(context, fileloc, size, dest_tmp, attr_tmp.st_size):
+        result = maybe_partial(context, fileloc, size, dest_tmp,
+                               attr_tmp.st_size)
+        if result is STOPPED:
+            # resumed again next run; a full transfer would truncate it
+            return False
+        if result:
             # if do_rename fails, redo full_transfer might not help
             return do_rename(context, dest_tmp, dest)
 
+    if utils.past(context.budget.deadline):
+        logger.info(f'Past the deadline; leaving {fileloc} for later')
+        return False
+
     # falling back or completely new file to sync
-    space_free = get_space_free()
+    with span('space_free'):
+        space_free = get_space_free()
     logger.info(f'Remote file {dest} does not exist: doing full transfer'
                 f', {space_free:,} bytes available at "{path}"'
                 f', sending {fileloc}')
@@ -179,5 +447,77 @@ def do_sync(context, fileloc, size, path, filename):
                      f', space after transfer {space_free - size:,} bytes')
         return False
 
-    return (full_transfer(context, fileloc, size, dest_tmp)
-            and do_rename(context, dest_tmp, dest))
+    return FULL_TRANSFER
+
+
+def do_sync(context, fileloc, size, path, filename):
+    with span('do_sync', file=fileloc, size=size):
+        result = prepare_sync(context, fileloc, size, path, filename)
+        if result is not FULL_TRANSFER:
+            return result
+
+        dest_tmp = tmp_path(path, filename)
+        return (full_transfer(context, fileloc, size, dest_tmp)
+                and do_rename(context, dest_tmp, path / filename))
+
+
+@traced
+def do_move(context, fileloc, size, source, path, filename, keep):
+    # source is the remote copy of a previously synchronized file with
+    # the same content; rename it into place, or copy it server-side if
+    # the local original is still there (keep)
+    min_free = context.config.getint('min_free')
+    dest = path / filename
+    logger.info(f'Trying {"copy" if keep else "move"} of remote {source}'
+                f' to {dest} for {fileloc} ({size:,} bytes)')
+
+    try:
+        attr = context.sftp.stat(str(source))
+    except FileNotFoundError:
+        logger.info(f'Remote {source} does not exist')
+        return False
+
+    if not stat.S_ISREG(attr.st_mode) or attr.st_size != size:
+        logger.warn(f'Remote {source} is not a file or has different size')
+        return False
+
+    algo = context.hash_algo
+    get_remote_hashsum = context.remote.hashsum(str(source), algo)
+    local_hashsum = local_hash(context, fileloc, size)
+    with span('remote_hash'):
+        remote_hashsum = get_remote_hashsum()
+
+    if remote_hashsum != local_hashsum:
+        logger.warn(f'Remote {source} ({remote_hashsum}) and local'
+                    f' ({local_hashsum}) files do not match')
+        return False
+
+    if not confirm_dir(context, path):
+        logger.error(f'Cannot make remote directory {path}')
+        return False
+
+    try:
+        context.sftp.stat(str(dest))
+        logger.info(f'Remote path {dest} exists')
+        return False
+    except FileNotFoundError:
+        pass
+
+    if not keep:
+        return do_rename(context, source, dest)
+
+    with span('space_free'):
+        space_free = context.remote.space_free(str(path))()
+    if space_free - size < min_free:
+        logger.error(f'Space available ({space_free:,} bytes)'
+                     f' is not enough to copy {source} to {dest}'
+                     f': min_free {min_free:,} bytes'
+                     f', size {size:,} bytes')
+        return False
+
+    dest_tmp = tmp_path(path, filename)
+    link = context.config.get('move_copy', 'copy') == 'link'
+    if not context.remote.copy(str(source), str(dest_tmp), link):
+        logger.warn(f'Failed copying remote {source} to {dest_tmp}')
+        return False
+    return do_rename(context, dest_tmp, dest)
@@ -1,26 +1,120 @@
 import os
+import time
 import fcntl
+import sqlite3
+import contextlib
 import fnmatch
+import collections
+import concurrent.futures
 from pathlib import Path
 
-from .context import create_context
+from . import utils
+from .batch import batchable
+from .budget import Budget
+from .hooks import SyncedFile, run_post_sync
+from .profiling import traced
+from .sync import remote_location, local_hash
+from .context import Context, create_context
 
 import logging
 logger = logging.getLogger('synconce.tracker')
 
 
 def init_db(db, cursor):
+    # only effective on a new database; see compact() for existing ones
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
     cursor.execute('''
                    CREATE TABLE IF NOT EXISTS synchronized(
                         pathname TEXT,
                         size INTEGER,
-                        datetime DATETIME DEFAULT CURRENT_TIMESTAMP
+                        datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        directory TEXT,
+                        algo TEXT,
+                        digest TEXT
                    )
                    ''')
     cursor.execute('''
                    CREATE UNIQUE INDEX IF NOT EXISTS synchronized_pathname
                    ON synchronized(pathname)
                    ''')
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS properties(
+                        name TEXT PRIMARY KEY,
+                        value TEXT
+                   )
+                   ''')
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS observed(
+                        pathname TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime_ns INTEGER,
+                        directory TEXT
+                   )
+                   ''')
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS observed_directory
+                   ON observed(directory)
+                   ''')
+    add_columns(cursor, ['directory', 'algo', 'digest'])
+    migrate_directory(db, cursor)
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS synchronized_directory
+                   ON synchronized(directory)
+                   ''')
+    cursor.execute('''
+                   CREATE INDEX IF NOT EXISTS synchronized_size_digest
+                   ON synchronized(size, digest)
+                   ''')
+    db.commit()
+
+
+def add_columns(cursor, columns):
+    cursor.execute('PRAGMA table_info(synchronized)')
+    existing = [column[1] for column in cursor.fetchall()]
+    for column in columns:
+        if column not in existing:
+            logger.info(f'Adding {column} column to tracker')
+            cursor.execute(
+                f'ALTER TABLE synchronized ADD COLUMN {column} TEXT')
+
+
+def migrate_directory(db, cursor, batch=10000):
+    while True:
+        cursor.execute('SELECT rowid, pathname FROM synchronized'
+                       ' WHERE directory IS NULL LIMIT ?', (batch,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany(
+            'UPDATE synchronized SET directory = ? WHERE rowid = ?',
+            [(directory_key(pathname), rowid) for rowid, pathname in rows])
+        db.commit()
+
+
+def directory_key(pathname):
+    return str(Path(pathname).parent)
+
+
+def get_property(context, name):
+    context.cursor.execute(
+        'SELECT value FROM properties WHERE name = ?', (name,))
+    value = context.cursor.fetchone()
+    return value[0] if value else None
+
+
+def set_property(context, name, value):
+    context.cursor.execute(
+        'REPLACE INTO properties(name, value) VALUES (?, ?)', (name, value))
+    context.db.commit()
+
+
+def record_hash_algo(context):
+    previous = get_property(context, 'hash_algo')
+    hash_algo = context.negotiated('hash_algo')
+    if hash_algo is not None and previous != hash_algo:
+        logger.info(f'Hash algorithm changed from {previous}'
+                    f' to {hash_algo}')
+        set_property(context, 'hash_algo', hash_algo)
 
 
 def get_size(context, pathname):
@@ -30,46 +124,294 @@ def get_size(context, pathname):
     return size[0] if size else None
 
 
-def set_size(context, pathname, size):
-    context.cursor.execute(
-        'REPLACE INTO synchronized(pathname, size) VALUES (?, ?)',
-        (str(pathname), size))
+def set_size(context, pathname, size, digest=None):
+    set_sizes(context, [(pathname, size, digest)])
+
+
+def set_sizes(context, rows):
+    # rows of (pathname, size, LocalDigest or None)
+    context.cursor.executemany(
+        'REPLACE INTO synchronized(pathname, size, directory, algo, digest)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        [(str(pathname), size, directory_key(pathname),
+          digest.algo if digest else None, digest.digest if digest else None)
+         for pathname, size, digest in rows])
+    context.cursor.executemany(
+        'DELETE FROM observed WHERE pathname = ?',
+        [(str(pathname), ) for pathname, size, digest in rows])
     context.db.commit()
 
 
-def maybe_sync(context, root, filename):
+def prune_directory(context, directory, filenames):
+    keep = {str(Path(directory, filename)) for filename in filenames}
+    pruned = 0
+
+    for table in ('synchronized', 'observed'):
+        context.cursor.execute(
+            f'SELECT pathname FROM {table} WHERE directory = ?',
+            (str(directory),))
+        tracked = [row[0] for row in context.cursor.fetchall()]
+        vanished = [(pathname,) for pathname in tracked
+                    if pathname not in keep]
+
+        if vanished:
+            logger.info(f'Pruning {len(vanished)} vanished files'
+                        f' from {table} in {directory}')
+            context.cursor.executemany(
+                f'DELETE FROM {table} WHERE pathname = ?', vanished)
+            context.db.commit()
+            if table == 'synchronized':
+                pruned += len(vanished)
+
+    return pruned
+
+
+def prune_all(context):
+    local_base = Path(context.config['local'])
+    context.cursor.execute('SELECT DISTINCT directory FROM synchronized')
+    pruned = 0
+
+    for (directory,) in context.cursor.fetchall():
+        try:
+            filenames = [entry.name for entry in
+                         os.scandir(local_base / directory)
+                         if not entry.is_dir()]
+        except (FileNotFoundError, NotADirectoryError):
+            filenames = []
+        pruned += prune_directory(context, directory, filenames)
+
+    return pruned
+
+
+def compact(context, pages=None, convert=True):
+    cursor = context.cursor
+    cursor.execute('PRAGMA auto_vacuum')
+    incremental = cursor.fetchone()[0] == 2
+    if not incremental and convert:
+        # switching an existing database requires one full VACUUM
+        logger.info('Enabling incremental vacuum on tracker (full VACUUM)')
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        incremental = True
+
+    if incremental:
+        cursor.execute('PRAGMA freelist_count')
+        logger.info(f'Tracker has {cursor.fetchone()[0]} free pages'
+                    f'; reclaiming {pages if pages is not None else "all"}')
+        if pages is None:
+            cursor.execute('PRAGMA incremental_vacuum').fetchall()
+        else:
+            cursor.execute(
+                f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+    else:
+        # too slow for a sync run on a large tracker
+        logger.info('Tracker is not in incremental vacuum mode'
+                    '; run --maintenance once to convert it')
+
+    # bounded-cost statistics refresh for the query planner
+    cursor.execute('PRAGMA analysis_limit = 1000')
+    cursor.execute('PRAGMA optimize')
+    context.db.commit()
+
+
+Candidate = collections.namedtuple(
+    'Candidate', ['full_pathname', 'pathname', 'size', 'path', 'filename'])
+
+
+def check_file(context, root, filename):
     logger.info(f'Checking {root}//{filename}')
     local_base = context.config['local']
     full_pathname = root / filename
     pathname = full_pathname.relative_to(local_base)
-    size = full_pathname.stat().st_size
+    attr = full_pathname.stat()
+    size = attr.st_size
 
     synchronized_size = get_size(context, pathname)
     logger.debug(f'{pathname}: size={size}, syncd_size={synchronized_size}')
 
-    if size != synchronized_size:
-        path = root.relative_to(local_base)
+    if size == synchronized_size:
+        return None
+
+    if not quiescent(context, pathname, attr):
+        return None
+
+    path, filename = remote_location(context.config, pathname)
+    return Candidate(full_pathname, pathname, size, path, filename)
+
+
+def quiescent(context, pathname, attr):
+    # whether the file seems to be no longer written to
+    config = context.config
+
+    age = time.time() - attr.st_mtime
+    if age < config.getfloat('min_age', 0):
+        logger.info(f'Deferring {pathname}: modified {age:.0f}s ago')
+        return False
+
+    if config.getboolean('check_open', False):
+        if context.writers is None:
+            context.writers = utils.open_for_write()
+        if (attr.st_dev, attr.st_ino) in context.writers:
+            logger.info(f'Deferring {pathname}: open for writing')
+            return False
+
+    if config.getboolean('require_stable', False):
+        context.cursor.execute(
+            'SELECT size, mtime_ns FROM observed WHERE pathname = ?',
+            (str(pathname),))
+        if context.cursor.fetchone() != (attr.st_size, attr.st_mtime_ns):
+            logger.info(f'Deferring {pathname}: not observed at this size'
+                        f' ({attr.st_size:,} bytes) before')
+            context.cursor.execute(
+                'REPLACE INTO observed(pathname, size, mtime_ns, directory)'
+                ' VALUES (?, ?, ?, ?)',
+                (str(pathname), attr.st_size, attr.st_mtime_ns,
+                 directory_key(pathname)))
+            context.db.commit()
+            return False
+
+    return True
+
+
+def with_reconnect(context, func, *args):
+    # on a dropped transport, reconnect and run func again; do_sync picks
+    # up an interrupted upload from its .synconce tmp file
+    attempts = context.config.getint('resume_attempts', 3)
+
+    for attempt in range(attempts + 1):
+        try:
+            result = func(context, *args)
+            if result or not context.transport_lost():
+                return result
+            logger.warn('Transport lost during synchronization')
+        except Exception as e:
+            if not context.transport_lost():
+                raise
+            logger.warn(f'Transport lost during synchronization: {e}')
+
+        if attempt == attempts or not context.reconnect():
+            context.gave_up = True
+            raise EOFError('Transport lost; giving up')
+
+        logger.info(f'Resuming (attempt {attempt + 1}/{attempts})')
+
+
+def take_digest(context, candidate):
+    digest = context.local_digests.pop(candidate.full_pathname, None)
+    if digest and digest.size != candidate.size:
+        return None
+    return digest
+
+
+def note_synced(context, candidate, digest):
+    config = context.config
+    if not config['post_sync']:
+        return
+
+    context.synced_files.append(SyncedFile(
+        str(candidate.path / candidate.filename), candidate.size,
+        digest.algo if digest else None, digest.digest if digest else None))
+
+    batch = config.getint('post_sync_batch', 0)
+    if batch and len(context.synced_files) >= batch:
+        flush_post_sync(context)
+
+
+def flush_post_sync(context):
+    if context.synced_files and context.config['post_sync']:
+        run_post_sync(context, context.synced_files)
+    context.synced_files = []
+
+
+def moved_from(context, candidate):
+    # a tracked pathname whose remote copy has the same content, if any
+    if (not context.config.getboolean('detect_moves', False)
+            or candidate.size == 0
+            or get_size(context, candidate.pathname) is not None):
+        return None
+
+    # only hash locally if anything could match
+    context.cursor.execute(
+        'SELECT EXISTS (SELECT 1 FROM synchronized'
+        ' WHERE size = ? AND digest IS NOT NULL)', (candidate.size,))
+    if not context.cursor.fetchone()[0]:
+        return None
+
+    digest = local_hash(context, candidate.full_pathname, candidate.size)
+    context.cursor.execute(
+        'SELECT pathname FROM synchronized'
+        ' WHERE size = ? AND digest = ? AND algo = ? LIMIT 1',
+        (candidate.size, digest, context.hash_algo))
+    row = context.cursor.fetchone()
+    return Path(row[0]) if row else None
+
+
+def delete_size(context, pathname):
+    context.cursor.execute('DELETE FROM synchronized WHERE pathname = ?',
+                           (str(pathname), ))
+    context.db.commit()
+
+
+def try_move(context, candidate):
+    source = moved_from(context, candidate)
+    if source is None:
+        return False
+
+    keep = (Path(context.config['local']) / source).exists()
+    source_path, source_filename = remote_location(context.config, source)
+    if not with_reconnect(context, context.do_move, candidate.full_pathname,
+                          candidate.size, source_path / source_filename,
+                          candidate.path, candidate.filename, keep):
+        return False
 
-        if context.config.get('flatten') is not None:
-            filename = str(path / filename)
-            path = Path()
-            filename = filename.replace(os.path.sep, context.config['flatten'])
+    if not keep:
+        delete_size(context, source)
+    record_synced(context, candidate)
+    return True
 
-        if context.do_sync(context, full_pathname, size, path, filename):
-            logger.info(f'Synchronization of {pathname} complete, size {size}')
-            set_size(context, pathname, size)
 
-            return True
+def sync_candidate(context, candidate):
+    full_pathname, pathname, size, path, filename = candidate
+
+    if try_move(context, candidate):
+        return True
+
+    if with_reconnect(context, context.do_sync,
+                      full_pathname, size, path, filename):
+        record_synced(context, candidate)
+        return True
 
     return False
 
 
-def execute_walk(context):
+def record_synced(context, candidate):
+    logger.info(f'Synchronization of {candidate.pathname} complete'
+                f', size {candidate.size}')
+    digest = take_digest(context, candidate)
+    set_size(context, candidate.pathname, candidate.size, digest)
+    note_synced(context, candidate, digest)
+
+
+def maybe_sync(context, root, filename):
+    candidate = check_file(context, root, filename)
+    return sync_candidate(context, candidate) if candidate else False
+
+
+def walk(context, trackers=None):
     config = context.config
+    prune = config.getboolean('prune', False)
 
-    synced = False
+    for tracker in trackers or [context]:
+        # open files are looked up once per walk
+        tracker.writers = None
 
     for root, dirs, files in os.walk(config['local']):
+        if prune:
+            for tracker in trackers or [context]:
+                prune_directory(tracker,
+                                Path(root).relative_to(config['local']),
+                                files)
+
         for filename in files:
             if fnmatch.fnmatch(filename, config['exclude']):
                 logger.info(f'Skipping {root}//{filename}'
@@ -80,15 +422,154 @@ def execute_walk(context):
                 logger.info(f'Skipping {root}//{filename}: is lock_file')
                 continue
 
-            this_synced = maybe_sync(context, Path(root), filename)
-            synced = synced or this_synced  # short-circuit calculation
+            yield Path(root), filename
 
-    return synced
 
+def walk_candidates(context):
+    for root, filename in walk(context):
+        candidate = check_file(context, root, filename)
+        if candidate:
+            yield candidate
 
-def execute(config, do_sync=None, exec_command=None):
-    logger.info(f'Starting sync for {dict(config)}')
 
+@traced
+def prefetch_candidate(candidate, algo, limit, io_mode):
+    if io_mode == 'direct':
+        # nothing is cached in direct mode; hashing ahead would only
+        # double the disk reads
+        return None
+
+    try:
+        return utils.prefetch(candidate.full_pathname, algo, limit)
+    except OSError as e:
+        # leave it to the network stage to report
+        logger.debug(f'Prefetching {candidate.full_pathname} failed: {e}')
+        return None
+
+
+def prefetched_candidates(context):
+    config = context.config
+    depth = config.getint('pipeline_depth', 2)
+    limit = config.getint('prefetch_max', 64 << 20)
+
+    if depth <= 0:
+        yield from walk_candidates(context)
+        return
+
+    # the walker and the network stage run in this thread (they share the
+    # tracker db); local reads/hashing of the next few candidates run in
+    # the prefetcher meanwhile. at most depth candidates are in flight.
+    pending = collections.deque()
+    candidates = walk_candidates(context)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as prefetcher:
+        while True:
+            while len(pending) < depth:
+                candidate = next(candidates, None)
+                if candidate is None:
+                    break
+                pending.append((candidate, prefetcher.submit(
+                    prefetch_candidate, candidate, context.hash_algo, limit,
+                    config.get('io_mode'))))
+
+            if not pending:
+                break
+
+            candidate, future = pending.popleft()
+            digest = future.result()
+            if digest:
+                context.local_digests[candidate.full_pathname] = digest
+
+            try:
+                yield candidate
+            finally:
+                context.local_digests.pop(candidate.full_pathname, None)
+
+
+def sync_batch(context, batch):
+    synced = with_reconnect(context, context.do_batch, batch)
+    digests = [take_digest(context, candidate) for candidate in synced]
+    set_sizes(context, [(candidate.pathname, candidate.size, digest)
+                        for candidate, digest in zip(synced, digests)])
+    for candidate, digest in zip(synced, digests):
+        note_synced(context, candidate, digest)
+
+    # whatever didn't make it goes through the per-file path, which
+    # knows how to deal with existing remote files
+    done = {candidate.pathname for candidate in synced}
+    result = bool(synced)
+    for candidate in batch:
+        if candidate.pathname not in done:
+            this_synced = sync_candidate(context, candidate)
+            result = result or this_synced  # short-circuit calculation
+
+    return result
+
+
+def remaining_size(context, candidate):
+    # what is likely left to send; a grown file only needs its tail. the
+    # budget is charged what is actually sent.
+    tracked = get_size(context, candidate.pathname)
+    if tracked is not None and tracked < candidate.size:
+        return candidate.size - tracked
+    return candidate.size
+
+
+def fits_budget(budget, targets, queued=0):
+    # targets are (context, candidate) for the destinations needing a file;
+    # queued bytes are scheduled (batched) but not charged yet
+    size = sum(remaining_size(context, candidate)
+               for context, candidate in targets)
+    if budget.fits(queued + size):
+        return True
+
+    logger.info(f'Deferring {targets[0][1].pathname} ({size:,} bytes)'
+                f': over budget')
+    budget.defer(size)
+    return False
+
+
+def execute_walk(context):
+    config = context.config
+    batch_max_size = config.getint('batch_max_size', 0)
+    batch_count = config.getint('batch_count', 1000)
+    batch_bytes = config.getint('batch_bytes', 64 << 20)
+
+    synced = False
+    batch = []
+
+    budget = context.budget
+
+    for candidate in prefetched_candidates(context):
+        if budget.exhausted():
+            budget.stopped = True
+            break
+        if not fits_budget(budget, [(context, candidate)],
+                           sum(c.size for c in batch)):
+            continue
+
+        if (batch_max_size and candidate.size <= batch_max_size
+                and batchable(candidate)):
+            batch.append(candidate)
+            if (len(batch) >= batch_count
+                    or sum(c.size for c in batch) >= batch_bytes):
+                this_synced = sync_batch(context, batch)
+                synced = synced or this_synced  # short-circuit calculation
+                batch = []
+            continue
+
+        this_synced = sync_candidate(context, candidate)
+        synced = synced or this_synced  # short-circuit calculation
+
+    if batch:
+        this_synced = sync_batch(context, batch)
+        synced = synced or this_synced  # short-circuit calculation
+
+    return synced
+
+
+@contextlib.contextmanager
+def locked(config):
     if config['lock_file']:
         local = Path(config['local'])
         try:
@@ -96,26 +577,98 @@ def execute(config, do_sync=None, exec_command=None):
             fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except OSError:
             logger.error('Another synconce in progress')
+            yield False
             return
     else:
         fd = -1
 
     try:
+        yield True
+    finally:
+        if fd != -1:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def finish(context):
+    if context.gave_up:
+        logger.warn('Finishing without a connection: transport lost')
+    elif not context.connected and not context.failed:
+        logger.info('Nothing to synchronize; not connected')
+
+    if context.connected or context.gave_up:
+        record_hash_algo(context)
+
+    if context.synced_files and (context.gave_up
+                                 or context.transport_lost()):
+        # one more try, just for post_sync
+        try:
+            reconnected = context.reconnect()
+        except Exception as e:
+            logger.debug(f'Reconnection failed: {e}')
+            reconnected = False
+        if not reconnected:
+            logger.error(f'Cannot run post_sync for'
+                         f' {len(context.synced_files)} synchronized files'
+                         f': transport lost')
+            context.synced_files = []
+
+    flush_post_sync(context)
+
+    if context.config.getboolean('prune', False):
+        compact(context, context.config.getint('vacuum_pages', 1000),
+                convert=False)
+
+
+def execute(config, do_sync=None, exec_command=None):
+    if config.get('destinations'):
+        from .fanout import execute_fanout
+        return execute_fanout(config, do_sync, exec_command)
+
+    logger.info(f'Starting sync for {dict(config)}')
+
+    with locked(config) as lock_acquired:
+        if not lock_acquired:
+            return
+
         with create_context(config) as context:
             if do_sync:
                 context.do_sync = do_sync
 
             if exec_command:
-                context.remote.exec_command = exec_command
+                context.exec_command = exec_command
 
+            context.budget = Budget.from_config(config)
             init_db(context.db, context.cursor)
-            synced = execute_walk(context)
+            try:
+                execute_walk(context)
+            except EOFError as e:
+                # still wrap up what was synchronized so far
+                logger.error(f'{e}; ending the run early')
+            finish(context)
+            context.budget.report()
 
-            if synced and config['post_sync']:
-                logger.info(f'Running post_sync: {config["post_sync"]}')
-                out, err = context.remote.exec_command(config['post_sync'])
-                logger.debug(f'post_sync out={repr(out)}, err={repr(err)}')
-    finally:
-        if fd != -1:
-            fcntl.lockf(fd, fcntl.LOCK_UN)
-            os.close(fd)
+
+def maintain(config):
+    if config.get('destinations'):
+        from .fanout import destination_configs
+        for destination in destination_configs(config):
+            maintain(destination)
+        return
+
+    logger.info(f'Starting maintenance for {dict(config)}')
+
+    with locked(config) as lock_acquired:
+        if not lock_acquired:
+            return
+
+        context = Context()
+        context.config = config
+
+        with contextlib.closing(sqlite3.connect(config['data'])) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            pruned = prune_all(context)
+            logger.info(f'Pruned {pruned} vanished files from tracker')
+            compact(context)
@@ -0,0 +1,93 @@
+import time
+import collections
+
+import logging
+logger = logging.getLogger('synconce.tuning')
+
+# paramiko's defaults
+DEFAULT_WINDOW_SIZE = 2 << 20
+DEFAULT_PACKET_SIZE = 32768
+DEFAULT_CHUNK_SIZE = 32768
+
+# OpenSSH's sftp-server drops messages over 256 KiB, headers included
+MAX_CHUNK_SIZE = 255 << 10
+# a pipelined paramiko SFTPFile waits for all outstanding writes once
+# more than this many are in flight, so at most about this many chunks
+# are sent per round trip
+WRITES_IN_FLIGHT = 100
+
+Tuning = collections.namedtuple(
+    'Tuning', ['window_size', 'packet_size', 'chunk_size'])
+
+
+def names(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def prefer(supported, wanted):
+    # the wanted algorithms first, in the given order, then the rest
+    for name in wanted:
+        if name not in supported:
+            logger.warn(f'Unsupported algorithm {name}; ignored')
+    first = [name for name in wanted if name in supported]
+    return tuple(first + [name for name in supported if name not in first])
+
+
+def transport_factory(config):
+    ciphers = names(config.get('ciphers'))
+    macs = names(config.get('macs'))
+
+    def factory(sock, **kwargs):
+        import paramiko
+        transport = paramiko.Transport(sock, **kwargs)
+        # must be set before the key exchange, i.e. before start_client()
+        options = transport.get_security_options()
+        if ciphers:
+            options.ciphers = prefer(options.ciphers, ciphers)
+        if macs:
+            options.digests = prefer(options.digests, macs)
+        return transport
+
+    return factory
+
+
+def measure_rtt(transport, samples=3):
+    # opening a channel takes one round trip
+    rtts = []
+    for i in range(samples):
+        start = time.perf_counter()
+        channel = transport.open_session()
+        rtts.append(time.perf_counter() - start)
+        channel.close()
+    return min(rtts)
+
+
+def chunk_for(rtt, bandwidth):
+    # enough bytes per write request for the writes in flight to cover
+    # the bandwidth-delay product
+    chunk_size = DEFAULT_CHUNK_SIZE
+    while (chunk_size * WRITES_IN_FLIGHT < bandwidth * rtt
+           and chunk_size < MAX_CHUNK_SIZE):
+        chunk_size <<= 1
+    return min(chunk_size, MAX_CHUNK_SIZE)
+
+
+def tune(config, transport):
+    # window_size and max_packet_size are what we advertise, so they only
+    # affect data coming back from the server (hashes, listings). uploads
+    # are bounded by the server's window and by the writes in flight.
+    window_size = config.getint('window_size', DEFAULT_WINDOW_SIZE)
+    packet_size = config.getint('max_packet_size', DEFAULT_PACKET_SIZE)
+    chunk_size = config.getint('chunk_size', 0)
+
+    if config.getboolean('auto_tune', False) and not chunk_size:
+        rtt = measure_rtt(transport)
+        # what the link can carry, in bytes per second
+        bandwidth = config.getint('bandwidth', 125000000)
+        chunk_size = chunk_for(rtt, bandwidth)
+        logger.info(f'Round trip {rtt * 1000:.1f}ms at {bandwidth:,} B/s'
+                    f': chunk {chunk_size:,} bytes'
+                    f' x {WRITES_IN_FLIGHT} writes in flight')
+
+    return Tuning(window_size, packet_size,
+                  min(chunk_size or DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE))
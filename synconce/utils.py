@@ -1,21 +1,124 @@
-import hashlib
+import io
+import os
+import time
+import errno
+import mmap
+import collections
 
+from . import hashes
 
-def append_transfer(srcf, destf):
+import logging
+logger = logging.getLogger('synconce.utils')
+
+
+LocalDigest = collections.namedtuple(
+    'LocalDigest', ['size', 'mtime_ns', 'algo', 'digest'])
+
+
+def past(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def append_transfer(srcf, destf, hasher=None, chunk=32768, deadline=None):
+    # stops short at the deadline; whatever was written is resumable
     transferred = 0
-    while len(data := srcf.read(32768)) > 0:
+    while not past(deadline) and len(data := srcf.read(chunk)) > 0:
         destf.write(data)
+        if hasher:
+            hasher.update(data)
         transferred += len(data)
     return transferred
 
 
+def data_extents(fileobj, start, end):
+    # [(offset, length)] of the data in [start, end), skipping holes; all
+    # of it if the filesystem can't tell. leaves the file offset alone.
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(start, end - start)]
+
+    fd = fileobj.fileno()
+    saved = os.lseek(fd, 0, os.SEEK_CUR)
+    extents = []
+    pos = start
+
+    try:
+        while pos < end:
+            try:
+                data = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # nothing but a hole up to EOF
+                    break
+                return [(start, end - start)]
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            extents.append((data, hole - data))
+            pos = hole
+    finally:
+        os.lseek(fd, saved, os.SEEK_SET)
+
+    return extents
+
+
+def hash_zeros(hasher, length, zeros=bytes(32768)):
+    while length > 0:
+        hasher.update(zeros[:length])
+        length -= len(zeros)
+
+
+def sparse_transfer(srcf, destf, start, end, hasher=None, chunk=32768,
+                    deadline=None):
+    # writes only the data extents of srcf[start:end] at the same offsets
+    # of destf, hashing holes as zeros; the caller truncates destf to end.
+    # None if srcf turned out shorter than end or the deadline passed.
+    transferred = 0
+    pos = start
+
+    for offset, length in data_extents(srcf, start, end):
+        if hasher:
+            hash_zeros(hasher, offset - pos)
+        srcf.seek(offset)
+        destf.seek(offset)
+
+        while (length > 0 and not past(deadline)
+               and len(data := srcf.read(min(chunk, length))) > 0):
+            destf.write(data)
+            if hasher:
+                hasher.update(data)
+            transferred += len(data)
+            length -= len(data)
+
+        if length > 0:
+            return None
+        pos = srcf.tell()
+
+    if os.fstat(srcf.fileno()).st_size < end:
+        # holes past EOF don't count
+        return None
+
+    if hasher:
+        hash_zeros(hasher, end - pos)
+    srcf.seek(end)
+    return transferred
+
+
 def head_sha1(fileobj, head_size):
-    sha1sum = hashlib.sha1()
+    return head_hash(fileobj, head_size, 'sha1')
+
+
+def head_hash(fileobj, head_size, algo):
+    hasher = head_hasher(fileobj, head_size, algo)
+    return hasher.hexdigest() if hasher else None
+
+
+def head_hasher(fileobj, head_size, algo):
+    hasher = hashes.new(algo)
     file_to_read = head_size
 
     while file_to_read > 0:
         data = fileobj.read(min(32768, file_to_read))
-        sha1sum.update(data)
+        hasher.update(data)
         file_to_read -= len(data)
         if len(data) == 0:
             break
@@ -24,4 +127,178 @@ def head_sha1(fileobj, head_size):
         # file reading ends early. broken file?
         return None
 
-    return sha1sum.hexdigest()
+    return hasher
+
+
+def prefetch(pathname, algo, limit):
+    # plain read even in fadvise mode: the pages should stay cached until
+    # the upload reads them again (and drops them behind itself)
+    with open(pathname, 'rb') as f:
+        attr = os.fstat(f.fileno())
+
+        if attr.st_size > limit:
+            # too large to hash ahead; only start readahead of the head
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, limit, os.POSIX_FADV_WILLNEED)
+            return None
+
+        # reading it through also warms the page cache for the upload
+        digest = head_hash(f, attr.st_size, algo)
+
+    if digest is None:
+        return None
+    return LocalDigest(attr.st_size, attr.st_mtime_ns, algo, digest)
+
+
+class FadviseReader(io.RawIOBase):
+    # reads ahead of the cursor with WILLNEED and drops pages behind it
+    # with DONTNEED, so a long sequential read doesn't evict the page cache
+    def __init__(self, pathname, window=8 << 20):
+        self.fd = os.open(pathname, os.O_RDONLY)
+        self.window = window
+        self.advised = 0
+        self.dropped = 0
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.fd
+
+    def tell(self):
+        return os.lseek(self.fd, 0, os.SEEK_CUR)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return os.lseek(self.fd, offset, whence)
+
+    def readinto(self, b):
+        n = os.readv(self.fd, [b])
+        pos = self.tell()
+
+        if pos + self.window // 2 > self.advised:
+            os.posix_fadvise(self.fd, pos, self.window,
+                             os.POSIX_FADV_WILLNEED)
+            self.advised = pos + self.window
+
+        if pos - self.dropped >= self.window:
+            self.drop(pos)
+
+        return n
+
+    def drop(self, pos):
+        if pos > self.dropped:
+            os.posix_fadvise(self.fd, self.dropped, pos - self.dropped,
+                             os.POSIX_FADV_DONTNEED)
+            self.dropped = pos
+
+    def close(self):
+        if not self.closed:
+            self.drop(self.tell())
+            os.close(self.fd)
+        super().close()
+
+
+class DirectReader(io.RawIOBase):
+    # O_DIRECT needs offsets, sizes and buffers aligned to the logical
+    # block size; reads go through an aligned (mmap) bounce buffer
+    ALIGN = mmap.PAGESIZE
+
+    def __init__(self, pathname, buffer_size=1 << 20):
+        self.fd = os.open(pathname, os.O_RDONLY | os.O_DIRECT)
+        self.buffer = mmap.mmap(-1, buffer_size)
+        self.buffer_start = 0
+        self.buffer_len = 0
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.fd
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = os.fstat(self.fd).st_size + offset
+        return self.pos
+
+    def readinto(self, b):
+        offset = self.pos - self.buffer_start
+        if not 0 <= offset < self.buffer_len:
+            self.buffer_start = self.pos - self.pos % self.ALIGN
+            self.buffer_len = os.preadv(self.fd, [self.buffer],
+                                        self.buffer_start)
+            offset = self.pos - self.buffer_start
+            if offset >= self.buffer_len:
+                return 0
+
+        n = min(len(b), self.buffer_len - offset)
+        b[:n] = self.buffer[offset:offset + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+            self.buffer.close()
+        super().close()
+
+
+def open_local(pathname, io_mode=None):
+    if io_mode == 'direct':
+        try:
+            return io.BufferedReader(DirectReader(pathname))
+        except OSError as e:
+            # e.g. tmpfs doesn't support O_DIRECT
+            logger.warn(f'Cannot open {pathname} with O_DIRECT ({e})'
+                        f'; using fadvise')
+            io_mode = 'fadvise'
+
+    if io_mode == 'fadvise' and hasattr(os, 'posix_fadvise'):
+        return io.BufferedReader(FadviseReader(pathname))
+
+    return open(pathname, 'rb')
+
+
+def open_for_write(proc='/proc'):
+    # (st_dev, st_ino) of every file some process has open for writing;
+    # without root, only our own user's processes are visible
+    writers = set()
+    try:
+        pids = [entry for entry in os.listdir(proc) if entry.isdigit()]
+    except OSError:
+        return writers
+
+    for pid in pids:
+        fd_dir = os.path.join(proc, pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+
+        for fd in fds:
+            try:
+                with open(os.path.join(proc, pid, 'fdinfo', fd)) as f:
+                    flags = next(int(line.split()[1], 8) for line in f
+                                 if line.startswith('flags:'))
+                if flags & os.O_ACCMODE == os.O_RDONLY:
+                    continue
+                attr = os.stat(os.path.join(fd_dir, fd))
+            except (OSError, StopIteration, ValueError):
+                continue
+            writers.add((attr.st_dev, attr.st_ino))
+
+    return writers
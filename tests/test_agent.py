@@ -0,0 +1,67 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+import hashlib
+import subprocess
+from pathlib import Path
+
+from synconce.agent import Agent, AgentRemote, AgentSFTP, HELPER_SOURCE
+
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.helper = subprocess.Popen(
+            [sys.executable, HELPER_SOURCE, str(self.tmpdir)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.agent = Agent(self.helper.stdin, self.helper.stdout)
+        self.remote = AgentRemote(None, str(self.tmpdir), self.agent)
+        self.sftp = AgentSFTP(None, self.agent)
+
+    def write_file(self, content, *path):
+        with open(self.tmpdir / Path(*path), 'w') as f:
+            print(content, file=f)
+
+    def test_stat(self):
+        self.write_file('hello', 'world')
+        attr = self.sftp.stat('world')
+        self.assertEqual(attr.st_size, 6)
+        self.assertEqual(attr.st_mode, (self.tmpdir / 'world').stat().st_mode)
+
+    def test_stat_not_found(self):
+        with self.assertRaises(FileNotFoundError):
+            self.sftp.stat('world')
+
+    def test_mkdir_rename(self):
+        self.write_file('hello', 'world')
+        self.sftp.mkdir('inner')
+        self.sftp.posix_rename('world', 'inner/world')
+        self.assertTrue((self.tmpdir / 'inner' / 'world').exists())
+        self.assertFalse((self.tmpdir / 'world').exists())
+
+    def test_pipelined(self):
+        self.write_file('hello', 'world')
+        get_space_free = self.remote.space_free('.')
+        get_hashsum = self.remote.hashsum('world', 'sha1')
+        get_missing = self.remote.hashsum('missing', 'sha1')
+        # collected out of order
+        self.assertEqual(get_hashsum(),
+                         hashlib.sha1(b'hello\n').hexdigest())
+        with self.assertRaises(FileNotFoundError):
+            get_missing()
+        vfs = os.statvfs(self.tmpdir)
+        self.assertAlmostEqual(get_space_free(), vfs.f_bavail * vfs.f_frsize,
+                               delta=1 << 24)
+
+    def tearDown(self):
+        self.helper.stdin.close()
+        self.helper.wait()
+        self.helper.stdout.close()
+        shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
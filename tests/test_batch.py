@@ -0,0 +1,129 @@
+import unittest
+
+import os
+import configparser
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+
+from synconce.context import Context
+from synconce.remote import Remote
+from synconce.batch import do_batch
+from synconce.tracker import Candidate
+
+
+class LocalChannel(object):
+    def __init__(self, proc):
+        self.proc = proc
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        self.proc.wait()
+
+
+class LocalChannelFile(object):
+    def __init__(self, fileobj, channel):
+        self.fileobj = fileobj
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class LocalSSH(object):
+    # runs "remote" commands locally, like SSHClient.exec_command
+    def exec_command(self, command):
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        channel = LocalChannel(proc)
+        return (LocalChannelFile(proc.stdin, channel),
+                LocalChannelFile(proc.stdout, channel),
+                LocalChannelFile(proc.stderr, channel))
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir_local = Path(tempfile.mkdtemp())
+        self.tmpdir_remote = Path(tempfile.mkdtemp())
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'sync_test': {
+                'local': str(self.tmpdir_local),
+                'min_free': '1000000',
+            }
+        })
+        self.context = Context()
+        self.context.config = config['sync_test']
+        self.context.remote = Remote(LocalSSH(), str(self.tmpdir_remote))
+        self.context.remote.space_free = lambda *args, **kwargs: \
+            lambda: 10000000
+
+    def write_file(self, base, content, *path):
+        path = base / Path(*path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            print(content, file=f)
+
+    def candidate(self, size, *path):
+        path = Path(*path)
+        return Candidate(self.tmpdir_local / path, path, size,
+                         path.parent, path.name)
+
+    def read_remote(self, *path):
+        with open(self.tmpdir_remote / Path(*path)) as f:
+            return f.read()
+
+    def test_batch(self):
+        self.write_file(self.tmpdir_local, 'hello', 'world')
+        self.write_file(self.tmpdir_local, 'hello!', 'in ner', 'world')
+        candidates = [self.candidate(6, 'world'),
+                      self.candidate(7, 'in ner', 'world')]
+
+        self.assertEqual(do_batch(self.context, candidates), candidates)
+        self.assertEqual(self.read_remote('world'), 'hello\n')
+        self.assertEqual(self.read_remote('in ner', 'world'), 'hello!\n')
+        self.assertEqual(sorted(os.listdir(self.tmpdir_remote)),
+                         ['in ner', 'world'])
+
+    def test_batch_existing(self):
+        self.write_file(self.tmpdir_local, 'hello', 'world')
+        self.write_file(self.tmpdir_local, 'hello', 'other')
+        self.write_file(self.tmpdir_remote, 'my', 'world')
+        candidates = [self.candidate(6, 'world'),
+                      self.candidate(6, 'other')]
+
+        self.assertEqual(do_batch(self.context, candidates), candidates[1:])
+        self.assertEqual(self.read_remote('world'), 'my\n')
+        self.assertEqual(self.read_remote('other'), 'hello\n')
+        self.assertFalse((self.tmpdir_remote / '.world.synconce').exists())
+
+    def test_batch_changed(self):
+        self.write_file(self.tmpdir_local, 'hello!', 'world')
+        self.write_file(self.tmpdir_local, 'hello', 'other')
+        candidates = [self.candidate(6, 'world'),
+                      self.candidate(6, 'other')]
+
+        self.assertEqual(do_batch(self.context, candidates), candidates[1:])
+        self.assertFalse((self.tmpdir_remote / 'world').exists())
+
+    def test_batch_full(self):
+        self.write_file(self.tmpdir_local, 'hello', 'world')
+        self.context.remote.space_free = lambda *args, **kwargs: \
+            lambda: 1000002
+        self.assertEqual(do_batch(self.context,
+                                  [self.candidate(6, 'world')]), [])
+        self.assertEqual(os.listdir(self.tmpdir_remote), [])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir_local)
+        shutil.rmtree(self.tmpdir_remote)
+
+
+if __name__ == '__main__':
+    unittest.main()
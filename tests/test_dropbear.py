@@ -80,6 +80,13 @@ class DropbearTest(unittest.TestCase):
         with open(os.path.join(self.tmpdir_remote, 'world')) as f:
             self.assertEqual(f.read(), 'hello\n')
 
+    def test_sync_single_helper(self):
+        self.config['helper'] = 'yes'
+        self.write_file(self.tmpdir_local, 'hello', 'inner', 'world')
+        execute(self.config)
+        with open(os.path.join(self.tmpdir_remote, 'inner', 'world')) as f:
+            self.assertEqual(f.read(), 'hello\n')
+
     def test_sync_partial(self):
         self.write_file(self.tmpdir_local, 'my\nhello', 'world')
         self.write_file(self.tmpdir_remote, 'my', 'world')
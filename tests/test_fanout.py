@@ -0,0 +1,182 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import configparser
+import shutil
+import tempfile
+import contextlib
+from pathlib import Path
+
+import sqlite3
+
+from synconce import utils
+from synconce.budget import Budget
+from synconce.context import Context, LazyContext
+from synconce.remote import Remote
+from synconce.tracker import init_db
+from synconce.fanout import destination_configs, walk_fanout
+
+from .test_sync import MockSFTP
+
+
+class FanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.tmpdirs_remote = [Path(tempfile.mkdtemp()) for i in range(3)]
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'sync_test': {
+                'data': ':memory:',
+                'local': str(self.tmpdir),
+                'host': '0.0.0.0',
+                'port': '22',
+                'user': 'nobody',
+                'rsa_key': '/dev/null',
+                'remote': '/',
+                'exclude': '*.excluded',
+                'min_free': '1000000',
+                'lock_file': '',
+                'post_sync': '',
+                'destinations': 'dest_a, dest_b, dest_c',
+            },
+            'dest_a': {'host': 'a', 'data': 'a.db'},
+            'dest_b': {'host': 'b', 'data': 'b.db'},
+            'dest_c': {'host': 'c', 'data': 'c.db'},
+        })
+        self.config = config['sync_test']
+
+        self.contexts = []
+        for destination, tmpdir in zip(destination_configs(self.config),
+                                       self.tmpdirs_remote):
+            context = Context()
+            context.config = destination
+            context.sftp = MockSFTP(tmpdir)
+            context.remote = Remote(None, None)
+            context.remote.space_free = lambda *args, **kwargs: \
+                lambda: 10000000
+            context.remote.hashsum = lambda *args, **kwargs: lambda: None
+            self.contexts.append(context)
+
+    def write_file(self, content, *path):
+        path = self.tmpdir / Path(*path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            print(content, file=f)
+
+    def test_destination_configs(self):
+        self.assertEqual([(config.name, config['host'], config['data'],
+                           config['user'])
+                          for config in destination_configs(self.config)],
+                         [('dest_a', 'a', 'a.db', 'nobody'),
+                          ('dest_b', 'b', 'b.db', 'nobody'),
+                          ('dest_c', 'c', 'c.db', 'nobody')])
+        self.assertNotIn('destinations',
+                         next(destination_configs(self.config)))
+
+    def test_destination_configs_defaults(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'DEFAULT': {'remote': '/default', 'root': '/srv'},
+            'sync_x': {'remote': '/from_section',
+                       'data': '%(root)s/x.db',
+                       'destinations': 'dest_a'},
+            'dest_a': {'host': 'a', 'local': '%(root)s/a'},
+        })
+        destination = next(destination_configs(config['sync_x']))
+        self.assertEqual(destination['remote'], '/from_section')
+        self.assertEqual(destination['data'], '/srv/x.db')
+        self.assertEqual(destination['local'], '/srv/a')
+
+    def test_destination_configs_missing(self):
+        self.config['destinations'] = 'dest_a, dest_x, dest_c'
+        with self.assertLogs('synconce.fanout', 'ERROR') as logs:
+            self.assertEqual([config.name for config
+                              in destination_configs(self.config)],
+                             ['dest_a', 'dest_c'])
+        self.assertIn('dest_x', logs.output[0])
+
+    def test_fanout_budget(self):
+        self.write_file('hello', 'inner', 'world')
+        budget = Budget(seconds=60)
+        budget.deadline = budget.start
+
+        with contextlib.ExitStack() as stack:
+            for context in self.contexts:
+                context.budget = budget
+                context.db = stack.enter_context(
+                    contextlib.closing(sqlite3.connect(':memory:')))
+                context.cursor = context.db.cursor()
+                init_db(context.db, context.cursor)
+
+            self.assertFalse(walk_fanout(self.contexts))
+
+        self.assertTrue(budget.stopped)
+        for tmpdir in self.tmpdirs_remote:
+            self.assertFalse((tmpdir / 'inner').exists())
+
+    def test_fanout_single_read(self):
+        self.write_file('hello', 'inner', 'world')
+
+        with contextlib.ExitStack() as stack:
+            for context in self.contexts:
+                context.db = stack.enter_context(
+                    contextlib.closing(sqlite3.connect(':memory:')))
+                context.cursor = context.db.cursor()
+                init_db(context.db, context.cursor)
+
+            # the middle one already has it
+            self.contexts[1].cursor.execute(
+                "INSERT INTO synchronized(pathname, size)"
+                " VALUES ('inner/world', 6)")
+
+            with patch('synconce.sync.utils.open_local',
+                       wraps=utils.open_local) as open_local:
+                self.assertTrue(walk_fanout(self.contexts))
+                open_local.assert_called_once()
+
+            for context in self.contexts:
+                context.do_sync = MagicMock()
+            self.assertFalse(walk_fanout(self.contexts))
+
+        for i in [0, 2]:
+            with open(self.tmpdirs_remote[i] / 'inner' / 'world') as f:
+                self.assertEqual(f.read(), 'hello\n')
+            self.assertFalse((self.tmpdirs_remote[i] / 'inner' /
+                              '.world.synconce').exists())
+        self.assertFalse((self.tmpdirs_remote[1] / 'inner').exists())
+
+    def test_fanout_unreachable(self):
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'inner', 'world')
+
+        # the middle one cannot connect
+        unreachable = LazyContext()
+        unreachable.config = self.contexts[1].config
+        unreachable.connect = MagicMock(side_effect=OSError('unreachable'))
+        self.contexts[1] = unreachable
+
+        with contextlib.ExitStack() as stack:
+            for context in self.contexts:
+                context.db = stack.enter_context(
+                    contextlib.closing(sqlite3.connect(':memory:')))
+                context.cursor = context.db.cursor()
+                init_db(context.db, context.cursor)
+
+            self.assertTrue(walk_fanout(self.contexts))
+
+        self.assertTrue(unreachable.failed)
+        unreachable.connect.assert_called_once()
+        for i in [0, 2]:
+            self.assertFalse(self.contexts[i].failed)
+            for path in [Path('world'), Path('inner', 'world')]:
+                with open(self.tmpdirs_remote[i] / path) as f:
+                    self.assertEqual(f.read(), 'hello\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for tmpdir in self.tmpdirs_remote:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
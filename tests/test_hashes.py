@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import os
+import hashlib
+import tempfile
+
+from synconce import hashes
+from synconce.remote import Remote
+
+from .test_batch import LocalSSH
+
+
+class HashesTest(unittest.TestCase):
+    def remote(self, *commands):
+        remote = MagicMock()
+        remote.probe_commands = MagicMock(return_value=set(commands))
+        return remote
+
+    def test_negotiate_fastest_common(self):
+        remote = self.remote('sha1sum', 'b2sum')
+        self.assertEqual(hashes.negotiate(remote, 'auto'), 'blake2b')
+
+    def test_negotiate_preference(self):
+        remote = self.remote('sha1sum', 'b2sum')
+        self.assertEqual(hashes.negotiate(remote, 'sha1, blake2b'), 'sha1')
+
+    def test_negotiate_fallback(self):
+        remote = self.remote()
+        self.assertEqual(hashes.negotiate(remote, 'blake2b'), 'sha1')
+
+    def test_negotiate_unknown(self):
+        remote = self.remote('sha1sum')
+        self.assertEqual(hashes.negotiate(remote, 'md4'), 'sha1')
+        remote.probe_commands.assert_not_called()
+
+    def test_probe_first_missing(self):
+        # the first candidate is missing remotely; the others still count
+        ssh = LocalSSH()
+        with tempfile.TemporaryDirectory() as bindir:
+            for name in ['b2sum', 'sha1sum']:
+                path = os.path.join(bindir, name)
+                with open(path, 'w') as f:
+                    f.write('#!/bin/sh\n')
+                os.chmod(path, 0o755)
+            remote = Remote(ssh, bindir)
+            found = remote.probe_commands(
+                [f'{bindir}/b3sum', f'{bindir}/b2sum', f'{bindir}/sha1sum'])
+        self.assertEqual(found, {'b2sum', 'sha1sum'})
+
+    def test_negotiate_first_missing(self):
+        remote = self.remote('b2sum', 'sha1sum')
+        with patch.object(hashes.ALGORITHMS['blake3'], 'available',
+                          return_value=True):
+            self.assertEqual(hashes.negotiate(remote, 'auto'), 'blake2b')
+
+    def test_parse_probe(self):
+        self.assertEqual(
+            hashes.parse_probe(b'/usr/bin/sha1sum\n/usr/bin/b2sum\n'),
+            {'sha1sum', 'b2sum'})
+
+    def test_local_matches_coreutils(self):
+        data = b'hello\n'
+        hasher = hashes.new('blake2b')
+        hasher.update(data)
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.blake2b(data).hexdigest())
+        self.assertEqual(hashes.get('blake2b').digest_size, 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
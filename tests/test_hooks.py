@@ -0,0 +1,59 @@
+import unittest
+from unittest.mock import MagicMock
+
+import io
+import json
+import configparser
+
+from synconce.context import Context
+from synconce.remote import Remote
+from synconce.hooks import SyncedFile, manifest, run_post_sync
+
+
+class HooksTest(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'sync_test': {
+                'post_sync': 'index',
+            }
+        })
+        self.context = Context()
+        self.context.config = config['sync_test']
+        self.context.remote = Remote(None, '/remote')
+        self.context.exec_command = MagicMock(return_value=(b'', b''))
+        self.context.sftp = MagicMock()
+        self.entries = [SyncedFile('world', 6, 'sha1', 'abc'),
+                        SyncedFile('in ner/world', 7, None, None)]
+
+    def test_manifest(self):
+        lines = manifest(self.entries).splitlines()
+        self.assertEqual(json.loads(lines[0]), {
+            'path': 'world', 'size': 6, 'algo': 'sha1', 'digest': 'abc'})
+        self.assertEqual(json.loads(lines[1])['path'], 'in ner/world')
+
+    def test_post_sync_plain(self):
+        run_post_sync(self.context, self.entries)
+        self.context.exec_command.assert_called_once_with('index')
+
+    def test_post_sync_stdin(self):
+        self.context.config['post_sync_input'] = 'stdin'
+        run_post_sync(self.context, self.entries)
+        self.context.exec_command.assert_called_once_with(
+            'index', manifest(self.entries))
+
+    def test_post_sync_manifest(self):
+        self.context.config['post_sync_input'] = 'manifest'
+        self.context.config['post_sync_manifest'] = 'new files.jsonl'
+        run_post_sync(self.context, self.entries)
+
+        fileobj, path, size = self.context.sftp.putfo.call_args[0]
+        self.assertEqual(path, 'new files.jsonl')
+        self.assertIsInstance(fileobj, io.BytesIO)
+        self.assertEqual(fileobj.getvalue(), manifest(self.entries))
+        self.context.exec_command.assert_called_once_with(
+            "index '/remote/new files.jsonl'")
+
+
+if __name__ == '__main__':
+    unittest.main()
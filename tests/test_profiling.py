@@ -0,0 +1,77 @@
+import unittest
+
+import io
+import os
+import json
+import shutil
+import tempfile
+
+from synconce import profiling
+
+
+class ProfilingTest(unittest.TestCase):
+    def trace(self, func):
+        trace = io.StringIO()
+        profiling.start_trace(trace)
+        try:
+            func()
+        finally:
+            profiling.stop_trace()
+        trace.seek(0)
+        return profiling.read_spans(trace)
+
+    def test_span_disabled(self):
+        with profiling.span('outer', file='x'):
+            pass
+
+    def test_span_nested(self):
+        @profiling.traced
+        def inner():
+            pass
+
+        def run():
+            with profiling.span('outer', file='x'):
+                inner()
+                inner()
+
+        spans = self.trace(run)
+        self.assertEqual([span['stack'] for span in spans],
+                         ['outer;inner', 'outer;inner', 'outer'])
+        self.assertEqual(spans[-1]['args'], {'file': 'x'})
+        # microseconds, rounded separately
+        self.assertAlmostEqual(spans[-1]['self'], spans[-1]['dur']
+                               - spans[0]['dur'] - spans[1]['dur'], delta=2)
+
+    def test_chrome(self):
+        spans = [{'name': 'do_sync', 'stack': 'do_sync', 'ts': 10,
+                  'dur': 5, 'self': 5, 'tid': 1, 'args': {}}]
+        event, = profiling.to_chrome(spans)['traceEvents']
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual((event['ts'], event['dur']), (10, 5))
+
+    def test_folded(self):
+        spans = [
+            {'stack': 'do_sync;full_transfer', 'self': 7},
+            {'stack': 'do_sync;full_transfer', 'self': 3},
+            {'stack': 'do_sync', 'self': 2},
+        ]
+        self.assertEqual(profiling.to_folded(spans),
+                         'do_sync 2\ndo_sync;full_transfer 10\n')
+
+    def test_profile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with profiling.profile(tmpdir, 'sync_test'):
+                with profiling.span('do_sync'):
+                    sum(range(1000))
+            self.assertEqual(sorted(os.listdir(tmpdir)), [
+                'sync_test.prof', 'sync_test.spans.jsonl',
+                'sync_test.tracemalloc', 'sync_test.txt'])
+            with open(os.path.join(tmpdir, 'sync_test.spans.jsonl')) as f:
+                self.assertEqual(json.loads(f.readline())['name'], 'do_sync')
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import configparser
+import hashlib
+import shutil
+import tempfile
+import contextlib
+from pathlib import Path
+
+import sqlite3
+
+from synconce.context import Context
+from synconce.remote import Remote
+from synconce.tracker import init_db
+from synconce.reconcile import reconcile_walk
+
+from .test_batch import LocalSSH
+
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir_local = Path(tempfile.mkdtemp())
+        self.tmpdir_remote = Path(tempfile.mkdtemp())
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'sync_test': {
+                'local': str(self.tmpdir_local),
+                'exclude': '',
+                'lock_file': '',
+            }
+        })
+        self.context = Context()
+        self.context.config = config['sync_test']
+        self.context.remote = Remote(LocalSSH(), str(self.tmpdir_remote))
+
+    def write_file(self, base, content, *path):
+        path = base / Path(*path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            print(content, file=f)
+
+    def tracked(self):
+        self.context.cursor.execute(
+            'SELECT pathname, size, digest FROM synchronized'
+            ' ORDER BY pathname')
+        return self.context.cursor.fetchall()
+
+    def reconcile(self):
+        context = self.context
+        for name in ['world', 'in ner/world', 'other', '-dash']:
+            self.write_file(self.tmpdir_local, 'hello', name)
+        self.write_file(self.tmpdir_remote, 'hello', 'world')
+        self.write_file(self.tmpdir_remote, 'jello', 'in ner', 'world')
+        self.write_file(self.tmpdir_remote, 'hello', '-dash')
+        self.write_file(self.tmpdir_remote, 'hello!', 'other')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+            init_db(context.db, context.cursor)
+            reconcile_walk(context)
+            return self.tracked()
+
+    def test_list_files(self):
+        self.write_file(self.tmpdir_remote, 'hello', 'in ner', 'world')
+        self.assertEqual(self.context.remote.list_files(),
+                         {'in ner/world': 6})
+
+    def test_reconcile_size(self):
+        self.assertEqual(self.reconcile(), [
+            ('-dash', 6, None), ('in ner/world', 6, None),
+            ('world', 6, None)])
+
+    def test_reconcile_hash(self):
+        self.context.config['reconcile_trust'] = 'hash'
+        self.context.config['reconcile_batch'] = '1'
+        digest = hashlib.sha1(b'hello\n').hexdigest()
+        self.assertEqual(self.reconcile(), [
+            ('-dash', 6, digest), ('world', 6, digest)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir_local)
+        shutil.rmtree(self.tmpdir_remote)
+
+
+if __name__ == '__main__':
+    unittest.main()
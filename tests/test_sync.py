@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import os
 import configparser
@@ -10,7 +10,8 @@ from pathlib import Path
 
 from synconce.context import Context
 from synconce.remote import Remote
-from synconce.sync import do_sync
+from synconce.sync import do_sync, do_move
+from synconce.utils import LocalDigest
 
 
 class MockSFTP(object):
@@ -103,6 +104,8 @@ class SyncTest(unittest.TestCase):
         with open(self.tmpdir / 'world') as f:
             self.assertEqual(f.read(), 'hello\n')
         self.assertFalse((self.tmpdir / '.world.synconce').exists())
+        self.assertEqual(self.context.local_digests[self.tmpfile].digest,
+                         hashlib.sha1(b'hello\n').hexdigest())
 
     def test_sync_single_bogus(self):
         self.write_file('hello')
@@ -192,6 +195,16 @@ class SyncTest(unittest.TestCase):
         with open(self.tmpdir / 'world') as f:
             self.assertEqual(f.read(), 'my\nhello\n')
         self.assertFalse((self.tmpdir / '.world.synconce').exists())
+        self.assertEqual(self.context.local_digests[self.tmpfile].digest,
+                         hashlib.sha1(b'my\nhello\n').hexdigest())
+
+    def test_sync_partial_in_tmp_direct(self):
+        self.context.config['io_mode'] = 'direct'
+        self.test_sync_partial_in_tmp()
+
+    def test_sync_partial_in_tmp_fadvise(self):
+        self.context.config['io_mode'] = 'fadvise'
+        self.test_sync_partial_in_tmp()
 
     def test_sync_partial_bogus_in_tmp(self):
         self.write_file('my\nhello')
@@ -236,6 +249,19 @@ class SyncTest(unittest.TestCase):
             self.assertEqual(f.read(), 'my\n')
         self.assertFalse((self.tmpdir / '.world.synconce').exists())
 
+    def test_sync_identical_prefetched(self):
+        self.write_file('my')
+        self.write_file('my', 'world')
+        attr = self.tmpfile.stat()
+        digest = hashlib.sha1(b'my\n').hexdigest()
+        self.context.local_digests[self.tmpfile] = LocalDigest(
+            3, attr.st_mtime_ns, 'sha1', digest)
+        self.context.remote.hashsum_mock = MagicMock(return_value=digest)
+        with patch('synconce.utils.head_hash') as head_hash:
+            self.assertTrue(do_sync(self.context, self.tmpfile, 3,
+                                    Path(), 'world'))
+            head_hash.assert_not_called()
+
     def test_sync_over(self):
         self.write_file('my')
         self.write_file('my\nhello', 'world')
@@ -287,6 +313,148 @@ class SyncTest(unittest.TestCase):
             self.assertEqual(f.read(), 'my\nhello\n')
         self.assertFalse((self.tmpdir / '.world.synconce').exists())
 
+    def test_sync_sparse(self):
+        self.context.config['sparse'] = 'yes'
+        with open(self.tmpfile, 'wb') as f:
+            f.truncate(3 << 20)
+            f.seek(1 << 20)
+            f.write(b'hello')
+        with open(self.tmpfile, 'rb') as f:
+            content = f.read()
+
+        self.assertTrue(do_sync(self.context, self.tmpfile, 3 << 20,
+                                Path(), 'world'))
+        with open(self.tmpdir / 'world', 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self.context.local_digests[self.tmpfile].digest,
+                         hashlib.sha1(content).hexdigest())
+
+    def test_sync_sparse_partial_in_tmp(self):
+        self.context.config['sparse'] = 'yes'
+        with open(self.tmpfile, 'wb') as f:
+            f.write(b'my\n')
+            f.truncate(3 << 20)
+        self.write_file('my', '.world.synconce')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'my\n').hexdigest())
+
+        self.assertTrue(do_sync(self.context, self.tmpfile, 3 << 20,
+                                Path(), 'world'))
+        with open(self.tmpdir / 'world', 'rb') as f:
+            self.assertEqual(f.read(), b'my\n'.ljust(3 << 20, b'\0'))
+        self.assertFalse((self.tmpdir / '.world.synconce').exists())
+
+    def test_sync_append(self):
+        self.context.config['append'] = 'tmp*'
+        self.write_file('my\nhello')
+        self.write_file('my', 'world')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'my\n').hexdigest())
+        self.assertTrue(do_sync(self.context, self.tmpfile, 9,
+                                Path(), 'world'))
+        with open(self.tmpdir / 'world') as f:
+            self.assertEqual(f.read(), 'my\nhello\n')
+        self.assertEqual(self.context.local_digests[self.tmpfile].digest,
+                         hashlib.sha1(b'my\nhello\n').hexdigest())
+
+    def test_sync_append_not_prefix(self):
+        self.context.config['append'] = 'tmp*'
+        self.write_file('my\nhello')
+        self.write_file('by', 'world')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'by\n').hexdigest())
+        self.assertFalse(do_sync(self.context, self.tmpfile, 9,
+                                 Path(), 'world'))
+        with open(self.tmpdir / 'world') as f:
+            self.assertEqual(f.read(), 'by\n')
+
+    def test_sync_append_atomic(self):
+        self.context.config['append'] = 'tmp*'
+        self.context.config['append_atomic'] = 'yes'
+        self.write_file('my\nhello')
+        self.write_file('my', 'world')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'my\n').hexdigest())
+        self.context.remote.copy = MagicMock(side_effect=lambda src, dest:
+                                             shutil.copy(self.tmpdir / src,
+                                                         self.tmpdir / dest))
+        self.assertTrue(do_sync(self.context, self.tmpfile, 9,
+                                Path(), 'world'))
+        self.context.remote.copy.assert_called_once_with(
+            'world', '.world.synconce')
+        self.context.remote.hashsum_mock.assert_called_once_with(
+            '.world.synconce', 'sha1')
+        with open(self.tmpdir / 'world') as f:
+            self.assertEqual(f.read(), 'my\nhello\n')
+        self.assertFalse((self.tmpdir / '.world.synconce').exists())
+
+    def test_sync_deadline(self):
+        self.write_file('hello')
+        self.context.budget.deadline = 0
+        self.assertFalse(do_sync(self.context, self.tmpfile, 6,
+                                 Path(), 'world'))
+        self.assertFalse((self.tmpdir / 'world').exists())
+        self.assertFalse((self.tmpdir / '.world.synconce').exists())
+
+    def test_sync_deadline_checkpoint(self):
+        self.write_file('my\nhello')
+        self.write_file('my', '.world.synconce')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'my\n').hexdigest())
+
+        # cut again before any more of it was sent: kept, not truncated
+        self.context.budget.deadline = 0
+        self.assertFalse(do_sync(self.context, self.tmpfile, 9,
+                                 Path(), 'world'))
+        with open(self.tmpdir / '.world.synconce') as f:
+            self.assertEqual(f.read(), 'my\n')
+        self.assertFalse((self.tmpdir / 'world').exists())
+
+        # resumed from it next time
+        self.context.budget.deadline = None
+        self.assertTrue(do_sync(self.context, self.tmpfile, 9,
+                                Path(), 'world'))
+        with open(self.tmpdir / 'world') as f:
+            self.assertEqual(f.read(), 'my\nhello\n')
+        self.assertEqual(self.context.budget.spent, 6)
+
+    def test_move(self):
+        self.write_file('hello')
+        self.write_file('hello', 'world')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'hello\n').hexdigest())
+        self.assertTrue(do_move(self.context, self.tmpfile, 6, Path('world'),
+                                Path('inner'), 'world', False))
+        with open(self.tmpdir / 'inner' / 'world') as f:
+            self.assertEqual(f.read(), 'hello\n')
+        self.assertFalse((self.tmpdir / 'world').exists())
+
+    def test_move_copy(self):
+        self.write_file('hello')
+        self.write_file('hello', 'world')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'hello\n').hexdigest())
+        self.context.remote.copy = MagicMock(side_effect=lambda src, dest, _:
+                                             shutil.copy(self.tmpdir / src,
+                                                         self.tmpdir / dest))
+        self.assertTrue(do_move(self.context, self.tmpfile, 6, Path('world'),
+                                Path(), 'again', True))
+        self.context.remote.copy.assert_called_once_with(
+            'world', '.again.synconce', False)
+        with open(self.tmpdir / 'again') as f:
+            self.assertEqual(f.read(), 'hello\n')
+        self.assertTrue((self.tmpdir / 'world').exists())
+
+    def test_move_mismatch(self):
+        self.write_file('hello')
+        self.write_file('jello', 'world')
+        self.context.remote.hashsum_mock = MagicMock(
+            return_value=hashlib.sha1(b'jello\n').hexdigest())
+        self.assertFalse(do_move(self.context, self.tmpfile, 6,
+                                 Path('world'), Path(), 'again', False))
+        self.assertTrue((self.tmpdir / 'world').exists())
+        self.assertFalse((self.tmpdir / 'again').exists())
+
     def tearDown(self):
         self.tmpfile.unlink()
         shutil.rmtree(self.tmpdir)
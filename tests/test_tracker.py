@@ -1,7 +1,10 @@
 import unittest
-from unittest.mock import MagicMock, call
+from unittest.mock import MagicMock, call, patch
 
+import os
 import configparser
+import hashlib
+import json
 import shutil
 import tempfile
 import contextlib
@@ -9,8 +12,10 @@ from pathlib import Path
 
 import sqlite3
 
-from synconce.context import Context
-from synconce.tracker import init_db, execute_walk
+from synconce.budget import Budget
+from synconce.context import Context, LazyContext, create_context
+from synconce.tracker import init_db, execute_walk, execute, \
+    get_property, record_hash_algo, prune_all, compact, flush_post_sync
 
 
 class TrackerTest(unittest.TestCase):
@@ -152,6 +157,539 @@ class TrackerTest(unittest.TestCase):
             context, self.tmpdir / 'inner' / 'world', 6,
             Path(), 'inner$world')
 
+    def test_tracker_serial(self):
+        context = self.context
+        context.config['pipeline_depth'] = '0'
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'inner', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            execute_walk(context)
+
+        self.assertEqual(context.do_sync.call_count, 2)
+
+    def test_tracker_prefetched(self):
+        context = self.context
+        digests = []
+
+        def do_sync(context, fileloc, *args):
+            digests.append(context.local_digests[fileloc].digest)
+            return True
+        context.do_sync = do_sync
+
+        self.write_file('hello', 'world')
+        self.write_file('hello!', 'inner', 'world')
+        self.write_file('hello!!', 'inner', 'deeper', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+
+        self.assertEqual(sorted(digests), sorted(
+            hashlib.sha1(content).hexdigest()
+            for content in [b'hello\n', b'hello!\n', b'hello!!\n']))
+        self.assertEqual(context.local_digests, {})
+
+    def test_tracker_prefetch_limit(self):
+        context = self.context
+        context.config['prefetch_max'] = '3'
+        context.do_sync = MagicMock(
+            side_effect=lambda context, *args: not context.local_digests)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            self.assertTrue(execute_walk(context))
+
+    def test_tracker_batch(self):
+        context = self.context
+        context.config['batch_max_size'] = '6'
+        context.config['batch_count'] = '2'
+        context.do_batch = MagicMock(
+            side_effect=lambda context, batch: batch[:1])
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'a')
+        self.write_file('hello', 'b')
+        self.write_file('hello', 'c')
+        self.write_file('hello!', 'large')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            execute_walk(context)
+
+        self.assertEqual(context.do_batch.call_count, 2)
+        self.assertEqual(
+            sum(len(args[1]) for args, kwargs in
+                context.do_batch.call_args_list), 3)
+        # one of each batch of two falls back, plus the large one
+        self.assertEqual(context.do_sync.call_count, 2)
+
+    def test_tracker_post_sync_batch(self):
+        context = self.context
+        context.config['post_sync_input'] = 'stdin'
+        context.config['post_sync_batch'] = '2'
+        context.do_sync = MagicMock(return_value=True)
+        context.exec_command = MagicMock(return_value=(b'', b''))
+
+        self.write_file('hello', 'a')
+        self.write_file('hello', 'b')
+        self.write_file('hello', 'c')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            self.assertEqual(context.exec_command.call_count, 1)
+            flush_post_sync(context)
+            flush_post_sync(context)
+
+        self.assertEqual(context.exec_command.call_count, 2)
+        entries = b''.join(args[1] for args, kwargs in
+                           context.exec_command.call_args_list).splitlines()
+        self.assertEqual(sorted(json.loads(entry)['path']
+                                for entry in entries), ['a', 'b', 'c'])
+        self.assertEqual({json.loads(entry)['digest'] for entry in entries},
+                         {hashlib.sha1(b'hello\n').hexdigest()})
+
+    def test_tracker_hash_algo(self):
+        context = self.context
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            self.assertIsNone(get_property(context, 'hash_algo'))
+
+            context.hash_algo = 'blake2b'
+            record_hash_algo(context)
+            self.assertEqual(get_property(context, 'hash_algo'), 'blake2b')
+
+    def tracked(self, context):
+        context.cursor.execute(
+            'SELECT pathname, directory FROM synchronized ORDER BY pathname')
+        return context.cursor.fetchall()
+
+    def test_tracker_directory(self):
+        context = self.context
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'in', 'ner', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            self.assertEqual(self.tracked(context), [
+                ('in/ner/world', 'in/ner'), ('world', '.')])
+
+    def test_tracker_migrate(self):
+        context = self.context
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+            context.cursor.execute(
+                'CREATE TABLE synchronized(pathname TEXT, size INTEGER,'
+                ' datetime DATETIME DEFAULT CURRENT_TIMESTAMP)')
+            context.cursor.execute(
+                "INSERT INTO synchronized(pathname, size)"
+                " VALUES ('inner/world', 6), ('world', 6)")
+
+            init_db(context.db, context.cursor)
+            self.assertEqual(self.tracked(context), [
+                ('inner/world', 'inner'), ('world', '.')])
+            context.cursor.execute('SELECT algo, digest FROM synchronized')
+            self.assertEqual(context.cursor.fetchall(),
+                             [(None, None), (None, None)])
+
+    def test_tracker_move(self):
+        context = self.context
+        context.config['detect_moves'] = 'yes'
+        context.do_sync = MagicMock(return_value=True)
+        context.do_move = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            context.do_move.assert_not_called()
+
+            (self.tmpdir / 'moved').mkdir()
+            (self.tmpdir / 'world').rename(self.tmpdir / 'moved' / 'world')
+            execute_walk(context)
+
+            context.do_move.assert_called_once_with(
+                context, self.tmpdir / 'moved' / 'world', 6, Path('world'),
+                Path('moved'), 'world', False)
+            self.assertEqual(context.do_sync.call_count, 1)
+            self.assertEqual(self.tracked(context),
+                             [('moved/world', 'moved')])
+
+    def test_tracker_move_copy(self):
+        context = self.context
+        context.config['detect_moves'] = 'yes'
+        context.do_sync = MagicMock(return_value=True)
+        context.do_move = MagicMock(return_value=False)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+
+            self.write_file('hello', 'copy')
+            self.write_file('other', 'other')
+            execute_walk(context)
+
+            # only copy matches by content; the failed copy falls back
+            context.do_move.assert_called_once_with(
+                context, self.tmpdir / 'copy', 6, Path('world'),
+                Path(), 'copy', True)
+            self.assertEqual(context.do_sync.call_count, 3)
+            self.assertEqual(self.tracked(context), [
+                ('copy', '.'), ('other', '.'), ('world', '.')])
+
+    def test_tracker_min_age(self):
+        context = self.context
+        context.config['min_age'] = '60'
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            context.do_sync.assert_not_called()
+
+            os.utime(self.tmpdir / 'world', (0, 0))
+            execute_walk(context)
+            context.do_sync.assert_called_once()
+
+    def test_tracker_require_stable(self):
+        context = self.context
+        context.config['require_stable'] = 'yes'
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            context.do_sync.assert_not_called()
+
+            self.write_file('hello, world', 'world')
+            execute_walk(context)
+            context.do_sync.assert_not_called()
+
+            execute_walk(context)
+            context.do_sync.assert_called_once()
+            context.cursor.execute('SELECT * FROM observed')
+            self.assertEqual(context.cursor.fetchall(), [])
+
+    def test_tracker_byte_budget(self):
+        context = self.context
+        context.config['pipeline_depth'] = '0'
+        context.budget = Budget(size=12)
+
+        def do_sync(context, fileloc, size, path, filename):
+            context.budget.take(size)
+            return True
+        context.do_sync = MagicMock(side_effect=do_sync)
+
+        self.write_file('hello', 'a')
+        self.write_file('hello, world', 'b')
+        self.write_file('hello', 'c')
+        self.write_file('hello', 'd')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+
+        self.assertEqual(context.do_sync.call_count, 2)
+        self.assertEqual(context.budget.spent, 12)
+        self.assertTrue(context.budget.stopped)
+
+    def test_tracker_budget_batch(self):
+        context = self.context
+        context.config['pipeline_depth'] = '0'
+        context.config['batch_max_size'] = '1000'
+        context.budget = Budget(size=150)
+
+        def do_batch(context, candidates):
+            context.budget.take(sum(c.size for c in candidates))
+            return candidates
+        context.do_batch = MagicMock(side_effect=do_batch)
+        context.do_sync = MagicMock(return_value=True)
+
+        for i in range(5):
+            self.write_file('x' * 99, f'file{i}')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+
+        context.do_batch.assert_called_once()
+        self.assertEqual(len(context.do_batch.call_args[0][1]), 1)
+        self.assertEqual(context.budget.spent, 100)
+        self.assertEqual(context.budget.deferred_files, 4)
+
+    def test_tracker_budget_tail(self):
+        context = self.context
+        context.config['pipeline_depth'] = '0'
+        context.budget = Budget(size=10)
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello, world', 'log')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            context.cursor.execute(
+                "INSERT INTO synchronized(pathname, size) VALUES ('log', 6)")
+            execute_walk(context)
+
+        # only the 7 byte tail counts, not the whole 13 bytes
+        context.do_sync.assert_called_once()
+        self.assertEqual(context.budget.deferred_files, 0)
+
+    def test_tracker_time_budget(self):
+        context = self.context
+        context.budget = Budget(seconds=60)
+        context.budget.deadline = context.budget.start
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            self.assertFalse(execute_walk(context))
+
+        context.do_sync.assert_not_called()
+        self.assertTrue(context.budget.stopped)
+
+    def test_tracker_prune_online(self):
+        context = self.context
+        context.config['prune'] = 'yes'
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'gone')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            (self.tmpdir / 'gone').unlink()
+            execute_walk(context)
+            self.assertEqual(self.tracked(context), [('world', '.')])
+
+    def test_tracker_prune_all(self):
+        context = self.context
+        context.do_sync = MagicMock(return_value=True)
+
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'inner', 'world')
+        self.write_file('hello', 'inner', 'deeper', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            execute_walk(context)
+            shutil.rmtree(self.tmpdir / 'inner' / 'deeper')
+            (self.tmpdir / 'world').unlink()
+
+            self.assertEqual(prune_all(context), 2)
+            self.assertEqual(self.tracked(context), [('inner/world', 'inner')])
+            compact(context)
+
+    def test_tracker_give_up_finishes(self):
+        config = self.context.config
+        config['pipeline_depth'] = '0'
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'inner', 'world')
+
+        def do_sync(context, *args):
+            if do_sync.calls:
+                raise EOFError('Transport lost; giving up')
+            do_sync.calls += 1
+            return True
+        do_sync.calls = 0
+        exec_command = MagicMock(return_value=(b'', b''))
+
+        execute(config, do_sync, exec_command)
+        exec_command.assert_called_once_with('echo POST_SYNC')
+
+    def test_tracker_give_up_lazy(self):
+        fd, data = tempfile.mkstemp()
+        os.close(fd)
+        config = self.context.config
+        config['data'] = data
+        config['pipeline_depth'] = '0'
+        config['reconnect_attempts'] = '1'
+        config['reconnect_delay'] = '0'
+        self.write_file('hello', 'world')
+        self.write_file('hello', 'inner', 'world')
+        active = [True]
+
+        def connect(context):
+            if connect.calls:
+                raise OSError('host unreachable')
+            connect.calls += 1
+            context.connected = True
+            context.ssh = MagicMock()
+            context.ssh.get_transport().is_active = lambda: active[0]
+            context.sftp = MagicMock()
+            context.hash_algo = 'blake2b'
+        connect.calls = 0
+
+        def do_sync(context, *args):
+            context.sftp
+            if do_sync.calls:
+                active[0] = False
+                raise EOFError()
+            do_sync.calls += 1
+            return True
+        do_sync.calls = 0
+        exec_command = MagicMock(return_value=(b'', b''))
+
+        try:
+            with patch.object(LazyContext, 'connect', autospec=True,
+                              side_effect=connect):
+                execute(config, do_sync, exec_command)
+
+            exec_command.assert_not_called()
+            with contextlib.closing(sqlite3.connect(data)) as db:
+                context = Context()
+                context.cursor = db.cursor()
+                self.assertEqual(get_property(context, 'hash_algo'),
+                                 'blake2b')
+                context.cursor.execute('SELECT COUNT(*) FROM synchronized')
+                self.assertEqual(context.cursor.fetchone()[0], 1)
+        finally:
+            os.unlink(data)
+
+    def test_tracker_compact_online(self):
+        context = self.context
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+            # an old tracker, created without incremental vacuum
+            context.cursor.execute(
+                'CREATE TABLE synchronized(pathname TEXT, size INTEGER,'
+                ' datetime DATETIME DEFAULT CURRENT_TIMESTAMP)')
+            init_db(context.db, context.cursor)
+
+            compact(context, 10, convert=False)
+            context.cursor.execute('PRAGMA auto_vacuum')
+            self.assertEqual(context.cursor.fetchone()[0], 0)
+
+            compact(context)
+            context.cursor.execute('PRAGMA auto_vacuum')
+            self.assertEqual(context.cursor.fetchone()[0], 2)
+
+    def test_tracker_lazy_noop(self):
+        # connecting to 0.0.0.0 with /dev/null as key would fail
+        execute(self.context.config)
+
+        self.write_file('hello', 'world.excluded')
+        execute(self.context.config)
+
+    def test_tracker_lazy_connect(self):
+        with create_context(self.context.config) as context:
+            def connect():
+                context.connected = True
+                context.ssh = MagicMock()
+                context.hash_algo = 'sha1'
+            context.connect = MagicMock(side_effect=connect)
+            context.do_sync = MagicMock(return_value=False)
+            init_db(context.db, context.cursor)
+
+            execute_walk(context)
+            context.connect.assert_not_called()
+
+            self.write_file('hello', 'world')
+            execute_walk(context)
+            context.connect.assert_called_once()
+
+    def test_tracker_reconnect(self):
+        context = self.context
+        context.config['pipeline_depth'] = '0'
+        lost = [False]
+        context.transport_lost = lambda: lost[0]
+        context.reconnect = MagicMock(
+            side_effect=lambda: lost.__setitem__(0, False) or True)
+
+        def do_sync(context, *args):
+            if context.do_sync.call_count == 1:
+                lost[0] = True
+                raise EOFError()
+            return True
+        context.do_sync = MagicMock(side_effect=do_sync)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            self.assertTrue(execute_walk(context))
+
+        context.reconnect.assert_called_once()
+        self.assertEqual(context.do_sync.call_count, 2)
+
+    def test_tracker_reconnect_give_up(self):
+        context = self.context
+        context.transport_lost = lambda: True
+        context.reconnect = MagicMock(return_value=True)
+        context.do_sync = MagicMock(return_value=False)
+
+        self.write_file('hello', 'world')
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as context.db:
+            context.cursor = context.db.cursor()
+
+            init_db(context.db, context.cursor)
+            with self.assertRaises(EOFError):
+                execute_walk(context)
+
+        self.assertEqual(context.reconnect.call_count, 3)
+        self.assertEqual(context.do_sync.call_count, 4)
+
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import MagicMock
+
+import socket
+import configparser
+
+from synconce import tuning
+
+
+class TuningTest(unittest.TestCase):
+    def config(self, **values):
+        config = configparser.ConfigParser()
+        config.read_dict({'sync_test': values})
+        return config['sync_test']
+
+    def test_prefer(self):
+        self.assertEqual(tuning.prefer(('a', 'b', 'c'), ['c', 'x', 'b']),
+                         ('c', 'b', 'a'))
+
+    def test_chunk_for(self):
+        self.assertEqual(tuning.chunk_for(0.001, 125000000),
+                         tuning.DEFAULT_CHUNK_SIZE)
+        self.assertEqual(tuning.chunk_for(0.05, 125000000), 64 << 10)
+        self.assertEqual(tuning.chunk_for(1, 125000000),
+                         tuning.MAX_CHUNK_SIZE)
+
+    def test_tune_defaults(self):
+        transport = MagicMock()
+        self.assertEqual(tuning.tune(self.config(), transport),
+                         (2 << 20, 32768, 32768))
+        transport.open_session.assert_not_called()
+
+    def test_tune_auto(self):
+        transport = MagicMock()
+        tuned = tuning.tune(self.config(auto_tune='yes',
+                                        bandwidth=str(10 ** 12)),
+                            transport)
+        self.assertEqual(transport.open_session.call_count, 3)
+        self.assertEqual(tuned.window_size, tuning.DEFAULT_WINDOW_SIZE)
+        self.assertGreaterEqual(tuned.chunk_size, tuning.DEFAULT_CHUNK_SIZE)
+        self.assertLessEqual(tuned.chunk_size, tuning.MAX_CHUNK_SIZE)
+
+    def test_tune_explicit(self):
+        transport = MagicMock()
+        tuned = tuning.tune(self.config(auto_tune='yes',
+                                        window_size=str(64 << 20),
+                                        chunk_size=str(1 << 20)),
+                            transport)
+        transport.open_session.assert_not_called()
+        self.assertEqual(tuned.window_size, 64 << 20)
+        self.assertEqual(tuned.chunk_size, tuning.MAX_CHUNK_SIZE)
+
+    def test_transport_factory(self):
+        factory = tuning.transport_factory(self.config(
+            ciphers='aes256-gcm@openssh.com, no-such-cipher',
+            macs='hmac-sha2-512'))
+        a, b = socket.socketpair()
+        try:
+            options = factory(a).get_security_options()
+            self.assertEqual(options.ciphers[0], 'aes256-gcm@openssh.com')
+            self.assertEqual(options.digests[0], 'hmac-sha2-512')
+        finally:
+            a.close()
+            b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
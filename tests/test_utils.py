@@ -1,9 +1,12 @@
 import unittest
 
 import io
+import os
 import hashlib
+import tempfile
 
-from synconce.utils import head_sha1
+from synconce.utils import head_sha1, head_hash, prefetch, open_local, \
+    open_for_write, data_extents, sparse_transfer
 
 
 class UtilsTest(unittest.TestCase):
@@ -29,6 +32,88 @@ class UtilsTest(unittest.TestCase):
         head_sha1(data, 60000)
         self.assertEqual(data.read(1), b'')
 
+    def test_head_hash_blake2b(self):
+        data = io.BytesIO(b'hello' * 10000)
+        digest = head_hash(data, 40000, 'blake2b')
+        expected = hashlib.blake2b((b'hello' * 10000)[:40000]).hexdigest()
+        self.assertEqual(digest, expected)
+
+    def test_prefetch(self):
+        fd, tmpfile = tempfile.mkstemp()
+        try:
+            os.write(fd, b'hello' * 10000)
+            os.close(fd)
+            self.assertEqual(prefetch(tmpfile, 'sha1', 50000).digest,
+                             hashlib.sha1(b'hello' * 10000).hexdigest())
+            self.assertIsNone(prefetch(tmpfile, 'sha1', 49999))
+        finally:
+            os.unlink(tmpfile)
+
+    def check_open_local(self, io_mode):
+        content = os.urandom(3 << 20 | 12345)
+        fd, tmpfile = tempfile.mkstemp()
+        try:
+            os.write(fd, content)
+            os.close(fd)
+            with open_local(tmpfile, io_mode) as f:
+                self.assertEqual(head_sha1(f, 40001),
+                                 hashlib.sha1(content[:40001]).hexdigest())
+                self.assertEqual(f.tell(), 40001)
+                self.assertEqual(f.read(), content[40001:])
+                f.seek(7)
+                self.assertEqual(f.read(3), content[7:10])
+        finally:
+            os.unlink(tmpfile)
+
+    def test_open_local_cached(self):
+        self.check_open_local(None)
+
+    def test_open_local_fadvise(self):
+        self.check_open_local('fadvise')
+
+    def test_open_local_direct(self):
+        self.check_open_local('direct')
+
+    def test_sparse_transfer(self):
+        with tempfile.TemporaryFile() as f:
+            f.truncate(3 << 20)
+            f.seek(1 << 20)
+            f.write(b'hello')
+            f.seek(0)
+            content = f.read()
+
+            extents = data_extents(f, 0, 3 << 20)
+            self.assertEqual(sum(length for offset, length in extents)
+                             < 1 << 20, os.fstat(f.fileno()).st_blocks
+                             * 512 < 1 << 20)
+            self.assertEqual(f.tell(), 3 << 20)
+
+            dest = io.BytesIO()
+            hasher = hashlib.sha1()
+            f.seek(0)
+            self.assertIsNotNone(sparse_transfer(f, dest, 0, 3 << 20, hasher))
+            dest.truncate(3 << 20)
+            self.assertEqual(hasher.hexdigest(),
+                             hashlib.sha1(content).hexdigest())
+            self.assertEqual(dest.getvalue().ljust(3 << 20, b'\0'), content)
+
+            self.assertIsNone(sparse_transfer(f, io.BytesIO(), 0, 4 << 20))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fdinfo'), 'needs /proc')
+    def test_open_for_write(self):
+        fd, tmpfile = tempfile.mkstemp()
+        try:
+            attr = os.fstat(fd)
+            self.assertIn((attr.st_dev, attr.st_ino), open_for_write())
+            os.close(fd)
+            self.assertNotIn((attr.st_dev, attr.st_ino), open_for_write())
+
+            with open(tmpfile, 'rb'):
+                self.assertNotIn((attr.st_dev, attr.st_ino),
+                                 open_for_write())
+        finally:
+            os.unlink(tmpfile)
+
 
 if __name__ == '__main__':
     unittest.main()